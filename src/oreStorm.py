@@ -5,7 +5,11 @@ Two Player Arcade Survival
 """
 
 from enum import Enum, IntEnum
-import os, pygame, random
+import argparse, collections, concurrent.futures, csv, gzip, heapq, json, logging, mmap, os, pygame, random, socket, struct, sys, tempfile, threading, time, zlib
+try:
+    import numpy
+except ImportError:
+    numpy = None # only needed for the block swarm
 
 # --- Global constants ---
 BLACK = (0, 0, 0)
@@ -23,48 +27,808 @@ BACKGROUNDCOLOR = WHITE
 
 FPS = 60
 
+# Fixed-step loop: movement constants are per simulation tick, so the
+# simulation always runs at SIM_RATE while the display rate can differ
+SIM_RATE = 60
+MAX_FRAMESKIP = 5 # most simulation steps run before a frame must be drawn
+MAX_FRAME_TIME = 0.25 # longer stalls (window drags, breakpoints) are clamped
+INTERPOLATION_MAX_DISTANCE = 64 # larger moves are teleports and are not interpolated
+
+# Network play: the plane player hosts, the ground player joins
+NET_PORT = 7777
+MAX_ROLLBACK = 8 # ticks a peer may run ahead of the other's confirmed input
+
+BATCH_MAX_TICKS = SIM_RATE * 60 * 10 # bot games end after ten minutes of game time
+
 # --- Game Resources ---
 SOUND_DATAPATH = 'data'
+LEVEL_DATAPATH = 'data'
 SOUNDS = IntEnum("SOUNDS", "PLANE_FIRE PICKUP_AMMO")
 #SOUNDS = IntEnum("SOUNDS", "PLANE_FIRE PLANE_COLLIDE PLAYER_JUMP PLAYER_DIE BLOCK_CRASH BLOCK_DIE")
+MIXER_FREQUENCY = 22050
+MIXER_BUFFER = 1024 # samples; sets the mixer's output latency
+# each sound plays on the channels reserved for its category
+SOUND_CATEGORIES = {SOUNDS.PLANE_FIRE: 'weapons', SOUNDS.PICKUP_AMMO: 'pickups'}
+CHANNEL_BUDGET = {'weapons': 3, 'pickups': 2} # voice limit per category
+SOUND_COOLDOWNS = {SOUNDS.PLANE_FIRE: 0.05, SOUNDS.PICKUP_AMMO: 0.1} # min seconds between plays
+
+
+# --- Logging ---
+# One logger per category; levels are set per category with setup_logging().
+# Hot paths pass %-style arguments so nothing is formatted while a level is off.
+LOG_CATEGORIES = ['audio', 'assets', 'bullet', 'pickup', 'block', 'plane', 'player', 'level', 'game', 'net', 'input', 'governor']
+log = logging.getLogger('oreStorm')
+audio_log = logging.getLogger('oreStorm.audio')
+assets_log = logging.getLogger('oreStorm.assets')
+bullet_log = logging.getLogger('oreStorm.bullet')
+pickup_log = logging.getLogger('oreStorm.pickup')
+block_log = logging.getLogger('oreStorm.block')
+plane_log = logging.getLogger('oreStorm.plane')
+player_log = logging.getLogger('oreStorm.player')
+level_log = logging.getLogger('oreStorm.level')
+game_log = logging.getLogger('oreStorm.game')
+net_log = logging.getLogger('oreStorm.net')
+input_log = logging.getLogger('oreStorm.input')
+governor_log = logging.getLogger('oreStorm.governor')
+
+
+class RingBufferHandler(logging.Handler):
+    """ Keeps the most recent log records in memory. emit() only appends to
+    a bounded deque, so the frame thread never formats or writes; records are
+    written out by a LogFlusher thread or by dump(). """
+    CAPACITY = 10000
+
+    def __init__(self, capacity=CAPACITY):
+        super().__init__()
+        self.records = collections.deque(maxlen=capacity)
+        self.pending = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+        self.pending.append(record)
 
+    def drain(self):
+        """ Removes and returns the records not yet flushed. """
+        records = []
+        while True:
+            try:
+                records.append(self.pending.popleft())
+            except IndexError:
+                return records
+
+    def dump(self, stream=None):
+        """ Writes every buffered record (flushed or not) to stream. """
+        stream = stream if stream is not None else sys.stderr
+        for record in list(self.records):
+            stream.write(self.format(record) + '\n')
+        stream.flush()
+
+
+class LogFlusher(threading.Thread):
+    """ Background thread that periodically writes new ring buffer records to a stream. """
+    INTERVAL = 0.5
+
+    def __init__(self, handler, stream, interval=INTERVAL):
+        super().__init__(daemon=True)
+        self.handler = handler
+        self.stream = stream
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        records = self.handler.drain()
+        if records:
+            self.stream.write(''.join(self.handler.format(record) + '\n' for record in records))
+            self.stream.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+log_buffer = None
+log_flusher = None
+
+def setup_logging(levels=None, stream=None):
+    """ Sets the level of each category (default WARNING) and routes all
+    records through the ring buffer. levels maps category names, or 'all',
+    to level names. If stream is given, a LogFlusher writes to it. """
+    global log_buffer, log_flusher
+    levels = levels or {}
+    default_level = levels.get('all', 'WARNING')
+    log.setLevel(logging.DEBUG)
+    log.propagate = False
+    for category in LOG_CATEGORIES:
+        logging.getLogger('oreStorm.' + category).setLevel(levels.get(category, default_level).upper())
+    if log_buffer is None:
+        log_buffer = RingBufferHandler()
+        log_buffer.setFormatter(logging.Formatter('%(relativeCreated)9.0f %(name)s %(levelname)s: %(message)s'))
+        log.addHandler(log_buffer)
+    if log_flusher is not None:
+        log_flusher.stop()
+        log_flusher = None
+    if stream is not None:
+        log_flusher = LogFlusher(log_buffer, stream)
+        log_flusher.start()
+
+def shutdown_logging():
+    """ Stops the flusher thread after writing any remaining records. """
+    global log_flusher
+    if log_flusher is not None:
+        log_flusher.stop()
+        log_flusher = None
+
+def dump_log(stream=None):
+    """ Writes the ring buffer contents on demand. """
+    if log_buffer is not None:
+        log_buffer.dump(stream)
 
 # --- Classes ---
 
 # Audio System
 class StandardAudio(object):
-    # TODO -- improve soundfile loading and playing using LocatorService to allow in-game muting/unmuting --
-
-    def __init__(self):
-        self.loadAudioFiles()
-
-    def play(self, audioID):
-        try:
-            index = int(audioID) - 1 # offset index as Enum starts at 1
-            self.sounds[index].play()
-        except:
-            print("failed to play sound: %s." % str(audioID.name))
+    """ Mixer-backed audio service. Each sound category gets its own reserved
+    channels (CHANNEL_BUDGET), so rapid PLANE_FIRE can never take the pickup
+    channels; a play is dropped when its category has no free voice or the
+    sound is still in its SOUND_COOLDOWNS window. Sounds are decoded on first
+    use, or all at once on a background thread with preload(). stats()
+    reports the mixer latency and played/dropped counts. """
+
+    def __init__(self, background_preload=True):
+        self.sounds = {}
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.last_played = {}
+        self.played = 0
+        self.dropped = collections.Counter()
+        self.channels = {}
+        if pygame.mixer.get_init() is None:
+            audio_log.warning("mixer not initialized -- every sound will be dropped")
+            return
+        reserved = sum(CHANNEL_BUDGET.values())
+        if pygame.mixer.get_num_channels() < reserved:
+            pygame.mixer.set_num_channels(reserved)
+        pygame.mixer.set_reserved(reserved)
+        first = 0
+        for category, count in sorted(CHANNEL_BUDGET.items()):
+            self.channels[category] = [pygame.mixer.Channel(i) for i in range(first, first + count)]
+            first += count
+        if background_preload:
+            self.preload()
+
+    def preload(self):
+        """ Decode every sound on a background thread. """
+        threading.Thread(target=self.loadAudioFiles, daemon=True).start()
 
     def loadAudioFiles(self):
-        self.sounds = []
         for item in SOUNDS:
-            try:
-                sound = pygame.mixer.Sound(os.path.join(SOUND_DATAPATH, str(item.name)+'.wav'))
-                self.sounds.append(sound)
+            self.get_sound(item)
+
+    def get_sound(self, audioID):
+        """ Returns the decoded sound, decoding it on first use, or None if it failed to load. """
+        sound = self.sounds.get(audioID)
+        if sound is None and audioID not in self.failed:
+            with self.lock:
+                sound = self.sounds.get(audioID)
+                if sound is None and audioID not in self.failed:
+                    path = os.path.join(SOUND_DATAPATH, str(audioID.name)+'.wav')
+                    try:
+                        sound = pygame.mixer.Sound(path)
+                        self.sounds[audioID] = sound
+                    except (pygame.error, OSError) as message:
+                        audio_log.error("failed to load %s: %s", path, message)
+                        self.failed.add(audioID)
+        return sound
 
-            except:
-                print(str(item.name)+'.wav')
-                raise UserWarning("Failed to load sound file in %s folder." % SOUND_DATAPATH)
+    def play(self, audioID):
+        now = time.perf_counter()
+        if now - self.last_played.get(audioID, -1e9) < SOUND_COOLDOWNS.get(audioID, 0):
+            self.dropped['cooldown'] += 1
+            return
+        channels = self.channels.get(SOUND_CATEGORIES.get(audioID), [])
+        channel = next((channel for channel in channels if not channel.get_busy()), None)
+        if channel is None:
+            self.dropped['voice_limit'] += 1
+            return
+        sound = self.get_sound(audioID)
+        if sound is None:
+            self.dropped['not_loaded'] += 1
+            return
+        channel.play(sound)
+        self.last_played[audioID] = now
+        self.played += 1
+
+    def stats(self):
+        """ Returns the mixer latency and play/drop counts. """
+        init = pygame.mixer.get_init()
+        latency = MIXER_BUFFER / init[0] * 1000 if init else None
+        return {'latency_ms': latency, 'played': self.played, 'dropped': dict(self.dropped),
+                'decoded': len(self.sounds)}
 
 
 class NullAudio(object):
     def __init__(self):
-        # Debug print
-        print("INFO: NullAudio initialized -- sound's muted!")
+        audio_log.info("NullAudio initialized -- sound's muted!")
 
     def play(self, audioID):
         pass
 
+    def stats(self):
+        return {'latency_ms': None, 'played': 0, 'dropped': {}, 'decoded': 0}
+
+
+class AudioLocator(object):
+    """ Service locator for the audio system; provide(None) falls back to NullAudio. """
+    service = None
+    null_service = None
+
+    @classmethod
+    def provide(cls, service):
+        if service is None:
+            if cls.null_service is None:
+                cls.null_service = NullAudio()
+            service = cls.null_service
+        cls.service = service
+
+    @classmethod
+    def get(cls):
+        if cls.service is None:
+            cls.provide(None)
+        return cls.service
+
+# Input Sources
+class ActionMap(object):
+    """ Maps raw pygame events to (action, pressed) pairs for Game and
+    RollbackSession, so the keyboard, mouse and gamepads drive the same
+    actions. The mapping has no state: a replayed or networked event always
+    maps to the same actions. Gamepad: D-pad or left stick to run, A (button
+    0) to jump, the right stick steers the plane (see LiveInput) and RB
+    (button 5) fires. Like the mouse button, fire triggers on release so the
+    click that restarts a game does not also shoot. """
+    # the only event types put on pygame's queue (see LiveInput)
+    EVENT_TYPES = (pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP,
+                   pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP, pygame.JOYHATMOTION, pygame.JOYAXISMOTION,
+                   pygame.JOYDEVICEADDED, pygame.JOYDEVICEREMOVED)
+    KEYS = {pygame.K_LEFT: 'left', pygame.K_RIGHT: 'right', pygame.K_UP: 'jump',
+            pygame.K_F12: 'dump_log', pygame.K_F3: 'toggle_overlay'}
+    JOY_BUTTONS = {0: 'jump', 5: 'fire'}
+    JOY_RUN_AXIS = 0
+    STICK_DEADZONE = 0.3
+    # who each action belongs to; the rest stay on the local machine in network play
+    PLAYERS = {'fire': 'plane', 'left': 'ground', 'right': 'ground', 'jump': 'ground'}
+
+    def actions(self, event):
+        kind = event.type
+        if kind == pygame.QUIT:
+            return [('quit', True)]
+        if kind in (pygame.KEYDOWN, pygame.KEYUP):
+            action = self.KEYS.get(event.key)
+            return [(action, kind == pygame.KEYDOWN)] if action else []
+        if kind == pygame.MOUSEBUTTONUP:
+            return [('fire', True)]
+        if kind in (pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP):
+            action = self.JOY_BUTTONS.get(event.button)
+            if action == 'fire':
+                return [('fire', True)] if kind == pygame.JOYBUTTONUP else []
+            return [(action, kind == pygame.JOYBUTTONDOWN)] if action else []
+        if kind == pygame.JOYHATMOTION:
+            return self.run_actions(event.value[0])
+        if kind == pygame.JOYAXISMOTION and event.axis == self.JOY_RUN_AXIS:
+            return self.run_actions(0 if abs(event.value) < self.STICK_DEADZONE else event.value)
+        return []
+
+    def run_actions(self, direction):
+        if direction < 0:
+            return [('left', True)]
+        if direction > 0:
+            return [('right', True)]
+        return [('left', False), ('right', False)]
+
+    def player(self, event):
+        """ 'plane' or 'ground' if the event drives that player, else None. """
+        for action, pressed in self.actions(event):
+            if action in self.PLAYERS:
+                return self.PLAYERS[action]
+        return None
+
+action_map = ActionMap()
+
+
+class InputLatency(object):
+    """ Measures input-to-display latency: the time from polling an input
+    (its timestamp) to the display flip of the first frame drawn after the
+    input was handled. Only live input carries timestamps. """
+    WINDOW = 600
+
+    def __init__(self, window=WINDOW):
+        self.samples = collections.deque(maxlen=window)
+        self.pending = []
+
+    def handled(self, event):
+        timestamp = getattr(event, 'timestamp', None)
+        if timestamp is not None:
+            self.pending.append(timestamp)
+
+    def frame_shown(self):
+        if self.pending:
+            now = time.perf_counter()
+            for timestamp in self.pending:
+                self.samples.append((now - timestamp) * 1000)
+            del self.pending[:]
+
+    def percentiles(self):
+        """ (p50, p95, p99) in ms, or None before the first sample. """
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return tuple(ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] for fraction in (0.5, 0.95, 0.99))
+
+
+class LiveInput(object):
+    """ Reads the mouse, keyboard and gamepads through pygame (normal play).
+    Only ActionMap.EVENT_TYPES are let onto the event queue; mouse motion,
+    window, audio device and text events are dropped by SDL instead of being
+    queued and walked here. The events already queued are drained first
+    and the handled ones posted again, so no early key press is lost. Gamepads
+    plugged in before launch are opened here, later ones on JOYDEVICEADDED.
+    Every polled event is stamped with the poll time. The plane
+    follows the mouse, or a cursor steered with a gamepad's right stick
+    while that is held. scale is the game's render_scale: the mouse moves
+    over a window that many times smaller than the view. """
+    CURSOR_SPEED = 10 # pixels per poll at full tilt
+    CURSOR_AXES = (2, 3)
+
+    def __init__(self, scale=1):
+        queued = pygame.event.get()
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed(ActionMap.EVENT_TYPES)
+        for event in queued:
+            if event.type in ActionMap.EVENT_TYPES:
+                pygame.event.post(event)
+        self.joysticks = {}
+        for index in range(pygame.joystick.get_count()):
+            self.open_joystick(index)
+        self.scale = scale
+        self.mouse_pos = pygame.mouse.get_pos()
+        self.pos = (self.mouse_pos[0] * scale, self.mouse_pos[1] * scale)
+
+    def poll(self):
+        """ Returns the events for this tick. """
+        events = pygame.event.get()
+        timestamp = time.perf_counter()
+        for event in events:
+            event.timestamp = timestamp
+            if event.type == pygame.JOYDEVICEADDED:
+                self.open_joystick(event.device_index)
+            elif event.type == pygame.JOYDEVICEREMOVED:
+                self.joysticks.pop(event.instance_id, None)
+                input_log.info("gamepad disconnected")
+        self.update_pos()
+        return events
+
+    def open_joystick(self, index):
+        joystick = pygame.joystick.Joystick(index)
+        instance_id = joystick.get_instance_id()
+        if instance_id not in self.joysticks:
+            self.joysticks[instance_id] = joystick
+            input_log.info("gamepad connected: %s", joystick.get_name())
+
+    def update_pos(self):
+        mouse_pos = pygame.mouse.get_pos()
+        if mouse_pos != self.mouse_pos:
+            self.mouse_pos = mouse_pos
+            self.pos = (mouse_pos[0] * self.scale, mouse_pos[1] * self.scale)
+            return
+        for joystick in self.joysticks.values():
+            if joystick.get_numaxes() <= max(self.CURSOR_AXES):
+                continue
+            x, y = [joystick.get_axis(axis) for axis in self.CURSOR_AXES]
+            if abs(x) >= ActionMap.STICK_DEADZONE or abs(y) >= ActionMap.STICK_DEADZONE:
+                self.pos = (min(max(self.pos[0] + int(x * self.CURSOR_SPEED), 0), SCREEN_WIDTH - 1),
+                            min(max(self.pos[1] + int(y * self.CURSOR_SPEED), 0), SCREEN_HEIGHT - 1))
+                return
+
+    def get_pos(self):
+        return self.pos
+
+
+class ScriptedInput(object):
+    """ Replays a list of per-tick frames in place of the mouse and keyboard.
+    Each frame is a (mouse_pos, events) tuple where events is a list of
+    (event_type, attribute_dict) tuples. The script loops when it runs out. """
+    def __init__(self, frames):
+        self.frames = frames
+        self.tick = -1
+        self.pos = (0, 0)
+
+    def poll(self):
+        self.tick += 1
+        pos, events = self.frames[self.tick % len(self.frames)]
+        self.pos = pos
+        return [pygame.event.Event(event_type, attributes) for event_type, attributes in events]
+
+    def get_pos(self):
+        return self.pos
+
+
+class InputRecorder(object):
+    """ Wraps another input source and records, per tick, the mouse position
+    and the events Game.process_events handles, plus a state checksum taken
+    after run_logic (register end_tick in Game.tick_hooks). The mouse is
+    sampled once per poll so fire() and update() see the same position.
+    Saved recordings replay through ScriptedInput with run_replay(). """
+    VERSION = 3
+    RECORDED_EVENTS = tuple(event_type for event_type in ActionMap.EVENT_TYPES
+                            if event_type not in (pygame.JOYDEVICEADDED, pygame.JOYDEVICEREMOVED))
+    EVENT_ATTRIBUTES = ('pos', 'button', 'key', 'axis', 'value', 'hat', 'instance_id')
+
+    def __init__(self, source, seed, swarm_size=0):
+        self.source = source
+        self.seed = seed
+        self.swarm_size = swarm_size
+        self.frames = []
+        self.checksums = []
+        self.pos = (0, 0)
+
+    def poll(self):
+        events = self.source.poll()
+        self.pos = tuple(self.source.get_pos())
+        recorded = []
+        for event in events:
+            if event.type in self.RECORDED_EVENTS:
+                attributes = dict((name, getattr(event, name)) for name in self.EVENT_ATTRIBUTES if hasattr(event, name))
+                recorded.append((event.type, attributes))
+        self.frames.append((self.pos, recorded))
+        return events
+
+    def get_pos(self):
+        return self.pos
+
+    def end_tick(self, game):
+        self.checksums.append(game.checksum())
+
+    def save(self, path):
+        recording = {'version': self.VERSION, 'pygame': pygame.version.ver, 'seed': self.seed,
+                     'swarm_size': self.swarm_size, 'frames': self.frames, 'checksums': self.checksums}
+        with gzip.open(path, 'wt') as recording_file:
+            json.dump(recording, recording_file, separators=(',', ':'))
+
+
+def load_recording(path):
+    """ Reads a recording saved by InputRecorder.save. """
+    with gzip.open(path, 'rt') as recording_file:
+        recording = json.load(recording_file)
+    if recording['version'] != InputRecorder.VERSION:
+        raise UserWarning("Unsupported recording version %s in %s." % (recording['version'], path))
+    # JSON turns tuples into lists
+    frames = []
+    for pos, events in recording['frames']:
+        for event_type, attributes in events:
+            if 'pos' in attributes:
+                attributes['pos'] = tuple(attributes['pos'])
+        frames.append((tuple(pos), [tuple(event) for event in events]))
+    recording['frames'] = frames
+    return recording
+
+
+def make_demo_script(rng, length):
+    """ Builds a ScriptedInput frame list: the plane sweeps across the screen
+    firing now and then, the ground player wanders and jumps. Clicks also
+    restart the game after a game over. """
+    frames = []
+    keys = [pygame.K_LEFT, pygame.K_RIGHT]
+    held = None
+    for tick in range(length):
+        x = (tick * 3) % (SCREEN_WIDTH * 2)
+        if x >= SCREEN_WIDTH:
+            x = SCREEN_WIDTH * 2 - x - 1
+        pos = (x, SCREEN_HEIGHT // 3)
+        events = []
+        if rng.randint(1, 100) > 90:
+            events.append((pygame.MOUSEBUTTONUP, {'pos': pos, 'button': 1}))
+        if rng.randint(1, 100) > 95:
+            if held is not None:
+                events.append((pygame.KEYUP, {'key': held}))
+            held = rng.choice(keys)
+            events.append((pygame.KEYDOWN, {'key': held}))
+        if rng.randint(1, 100) > 97:
+            events.append((pygame.KEYDOWN, {'key': pygame.K_UP}))
+        frames.append((pos, events))
+    return frames
+
+# Bot players
+class GroundBot(object):
+    """ Plays the ground player with the arrow keys: runs out from under
+    blocks that are about to land on it, otherwise walks to the nearest ammo
+    box, and jumps over gaps in the floor. """
+    DANGER_TICKS = 60 # how far ahead a falling block counts as a threat
+    MARGIN = 4 # clearance kept from a falling block, in pixels
+
+    def __init__(self):
+        self.held = None
+
+    def threats(self, game):
+        """ Rects of the blocks that will land on the player soon. """
+        rect = game.player2.rect
+        threats = []
+        for block in game.block_list:
+            if block.rect.right + self.MARGIN <= rect.left or block.rect.left - self.MARGIN >= rect.right:
+                continue
+            distance = rect.top - block.rect.bottom
+            if 0 <= distance <= self.DANGER_TICKS * max(block.change_y, 1):
+                threats.append(block.rect)
+        if game.swarm:
+            zone = pygame.Rect(rect.left - self.MARGIN, rect.top - self.DANGER_TICKS,
+                               rect.width + 2 * self.MARGIN, self.DANGER_TICKS)
+            threats.extend(game.swarm.rect(index) for index in numpy.flatnonzero(game.swarm.overlap(zone)).tolist())
+        return threats
+
+    def choose(self, game):
+        """ Returns the direction to run: -1 left, 1 right or 0. """
+        rect = game.player2.rect
+        threats = self.threats(game)
+        if threats:
+            left = rect.right - min(threat.left for threat in threats) + self.MARGIN
+            right = max(threat.right for threat in threats) - rect.left + self.MARGIN
+            # the world ends on the left only
+            if rect.left - left < 0:
+                return 1
+            return -1 if left <= right else 1
+        if game.pickups_list:
+            target = min(game.pickups_list, key=lambda pickup: abs(pickup.rect.centerx - rect.centerx))
+            dx = target.rect.centerx - rect.centerx
+            if abs(dx) > GroundPlayer.PLAYER_SPEED:
+                return 1 if dx > 0 else -1
+        return 0
+
+    def gap_ahead(self, game, direction):
+        player = game.player2
+        tile_map = game.current_level.get_tile_map()
+        if player.change_y != 0:
+            return False
+        ahead = player.rect.centerx + direction * (player.rect.width // 2 + tile_map.tile_size)
+        return not tile_map.solid_at(ahead, player.rect.bottom + 1)
+
+    def think(self, game):
+        """ Returns this tick's (event_type, attributes) list. """
+        direction = self.choose(game)
+        key = {-1: pygame.K_LEFT, 1: pygame.K_RIGHT}.get(direction)
+        events = []
+        if key != self.held:
+            if self.held is not None:
+                events.append((pygame.KEYUP, {'key': self.held}))
+            if key is not None:
+                events.append((pygame.KEYDOWN, {'key': key}))
+            self.held = key
+        if direction and self.gap_ahead(game, direction):
+            events.append((pygame.KEYDOWN, {'key': pygame.K_UP}))
+        return events
+
+
+class PlaneBot(object):
+    """ Flies the plane under the block closest to landing on the ground
+    player and fires when lined up with it; with no ammo, or once the block
+    is below the plane, it rams the block. """
+    ALTITUDE = SCREEN_HEIGHT // 2
+    SPEED = 12 # pixels the mouse moves per tick
+
+    def __init__(self):
+        self.pos = (SCREEN_WIDTH // 2, self.ALTITUDE)
+
+    def target(self, game):
+        """ Rect of the visible block nearest to landing on the ground player, or None. """
+        player = game.player2.rect
+        danger = lambda rect: abs(rect.centerx - player.centerx) + (player.top - rect.bottom)
+        rects = [block.rect for block in game.block_list if block.rect.bottom > 0]
+        swarm = game.swarm
+        if swarm:
+            bottom = swarm.y + swarm.height
+            scores = numpy.abs(swarm.x + swarm.width // 2 - player.centerx) + (player.top - bottom)
+            scores = numpy.where(swarm.alive & (bottom > 0), scores, numpy.iinfo(scores.dtype).max)
+            index = int(numpy.argmin(scores))
+            if swarm.alive[index] and bottom[index] > 0:
+                rects.append(swarm.rect(index))
+        if not rects:
+            return None
+        return min(rects, key=danger)
+
+    def think(self, game):
+        block = self.target(game)
+        if block is None:
+            return []
+        plane = game.player
+        block = game.camera.apply(block)
+        armed = plane.ammo > 0 and block.bottom < self.ALTITUDE
+        goal = (block.centerx, self.ALTITUDE if armed else block.centery)
+        dx = max(-self.SPEED, min(self.SPEED, goal[0] - self.pos[0]))
+        dy = max(-self.SPEED, min(self.SPEED, goal[1] - self.pos[1]))
+        self.pos = (self.pos[0] + dx, self.pos[1] + dy)
+        lined_up = abs(block.centerx - self.pos[0]) < Block.BLOCK_WIDTH // 2
+        # one bullet at a time per block
+        in_flight = any(game.camera.apply(bullet.rect).colliderect(block.left, block.bottom, block.width, SCREEN_HEIGHT)
+                        for bullet in game.bullet_list)
+        if armed and lined_up and not in_flight:
+            return [(pygame.MOUSEBUTTONUP, {'pos': self.pos, 'button': 1})]
+        return []
+
+
+class BotInput(object):
+    """ Input source played by a PlaneBot and a GroundBot through the normal
+    event path. Set game after creating the Game. Also counts the ammo
+    economy: shots fired, dry clicks and ammo picked up. """
+    def __init__(self):
+        self.game = None
+        self.plane = PlaneBot()
+        self.ground = GroundBot()
+        self.fired = 0
+        self.dry = 0
+        self.gained = 0
+        self.ammo = PlanePlayer.PLANE_AMMO
+
+    def poll(self):
+        game = self.game
+        if game.player.ammo > self.ammo:
+            self.gained += game.player.ammo - self.ammo
+        events = self.plane.think(game) + self.ground.think(game)
+        if any(event_type == pygame.MOUSEBUTTONUP for event_type, attributes in events):
+            if game.player.ammo > 0:
+                self.fired += 1
+                self.ammo = game.player.ammo - 1
+            else:
+                self.dry += 1
+        else:
+            self.ammo = game.player.ammo
+        return [pygame.event.Event(event_type, attributes) for event_type, attributes in events]
+
+    def get_pos(self):
+        return self.plane.pos
+
+# Collision broad-phase
+class SpatialHashGroup(pygame.sprite.Group):
+    """ Sprite group that also keeps its sprites in a uniform grid so that
+    collision queries only look at nearby sprites. Static sprites are bucketed
+    once when added; call refresh() after moving sprites to re-bucket the ones
+    that changed cells. Query results keep the group's insertion order so they
+    match pygame.sprite.spritecollide exactly. """
+    CELL_SIZE = 32
+
+    def __init__(self, *sprites, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.sprite_cells = {}
+        self.sprite_order = {}
+        self.next_order = 0
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, *args):
+        super().add_internal(sprite, *args)
+        self.sprite_order[sprite] = self.next_order
+        self.next_order += 1
+        cell_range = self.cell_range(sprite.rect)
+        self.sprite_cells[sprite] = cell_range
+        self.insert_cells(sprite, cell_range)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        self.remove_cells(sprite, self.sprite_cells.pop(sprite))
+        del self.sprite_order[sprite]
+
+    def cell_range(self, rect):
+        """ Returns the (left, top, right, bottom) cells a rect covers. """
+        size = self.cell_size
+        return (rect.left // size, rect.top // size, (rect.right - 1) // size, (rect.bottom - 1) // size)
+
+    def insert_cells(self, sprite, cell_range):
+        left, top, right, bottom = cell_range
+        for x in range(left, right + 1):
+            for y in range(top, bottom + 1):
+                self.cells.setdefault((x, y), set()).add(sprite)
+
+    def remove_cells(self, sprite, cell_range):
+        left, top, right, bottom = cell_range
+        for x in range(left, right + 1):
+            for y in range(top, bottom + 1):
+                bucket = self.cells[(x, y)]
+                bucket.discard(sprite)
+                if not bucket:
+                    del self.cells[(x, y)]
+
+    def refresh(self):
+        """ Re-bucket sprites whose rects moved into different cells. """
+        for sprite, old_range in list(self.sprite_cells.items()):
+            new_range = self.cell_range(sprite.rect)
+            if new_range != old_range:
+                self.remove_cells(sprite, old_range)
+                self.insert_cells(sprite, new_range)
+                self.sprite_cells[sprite] = new_range
+
+    def collide(self, sprite, dokill=False, collided=None):
+        """ Same result as pygame.sprite.spritecollide(sprite, self, dokill, collided). """
+        rect = sprite.rect
+        left, top, right, bottom = self.cell_range(rect)
+        hits = set()
+        for x in range(left, right + 1):
+            for y in range(top, bottom + 1):
+                bucket = self.cells.get((x, y))
+                if bucket:
+                    for other in bucket:
+                        if rect.colliderect(other.rect):
+                            hits.add(other)
+        hits = sorted(hits, key=self.sprite_order.__getitem__)
+        if collided is not None:
+            hits = [other for other in hits if collided(sprite, other)]
+        if dokill:
+            for other in hits:
+                other.kill()
+        return hits
+
+
+def spritecollide(sprite, group, dokill, collided=None):
+    """ pygame.sprite.spritecollide that uses the grid of a SpatialHashGroup.
+    collided is only called for sprites whose rects overlap. """
+    if isinstance(group, SpatialHashGroup):
+        return group.collide(sprite, dokill, collided)
+    if collided is None:
+        return pygame.sprite.spritecollide(sprite, group, dokill)
+    hits = [other for other in pygame.sprite.spritecollide(sprite, group, False) if collided(sprite, other)]
+    if dokill:
+        for other in hits:
+            other.kill()
+    return hits
+
+def collide_mask_rect(sprite, rect):
+    """ True if an opaque pixel of sprite (its mask) lies inside rect. """
+    return sprite.mask.overlap(asset_manager.solid_mask(rect.size),
+                               (rect.x - sprite.rect.x, rect.y - sprite.rect.y)) is not None
+
+def collide_solid(sprite, other):
+    """ spritecollide() callback: sprite's pixels against other's whole rect,
+    for solid sprites like the blocks. """
+    return collide_mask_rect(sprite, other.rect)
+
+def groupcollide(groupa, groupb, dokilla, dokillb):
+    """ pygame.sprite.groupcollide that uses the grid of a SpatialHashGroup. """
+    crashed = {}
+    for sprite in groupa.sprites():
+        collision = spritecollide(sprite, groupb, dokillb)
+        if collision:
+            crashed[sprite] = collision
+            if dokilla:
+                sprite.kill()
+    return crashed
+
+# Shared images
+class ImageCache(object):
+    """ Process-wide flyweight cache of solid-colour surfaces keyed by
+    (size, colour, flags). Every sprite of the same size and colour shares
+    one surface, converted to the display format when a display is set.
+    Cached surfaces are shared, so never draw into them. """
+    def __init__(self):
+        self.surfaces = {}
+
+    def get(self, size, color, flags=0):
+        key = (tuple(size), tuple(color), flags)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = pygame.Surface(key[0], flags)
+            if pygame.display.get_surface() is not None:
+                if flags & pygame.SRCALPHA:
+                    surface = surface.convert_alpha()
+                else:
+                    surface = surface.convert()
+            surface.fill(color)
+            self.surfaces[key] = surface
+        return surface
+
+    def clear(self):
+        self.surfaces = {}
+
+image_cache = ImageCache()
+
 # Spritesheet handling class from pygame cookbook
 # modified -- added transforming loop
 class Spritesheet(object):
@@ -72,7 +836,7 @@ class Spritesheet(object):
         try:
             self.sheet = pygame.image.load(filename).convert()
         except pygame.error as message:
-            print('Unable to load spritesheet image:', filename)
+            assets_log.error("Unable to load spritesheet image: %s", filename)
             raise SystemExit(message)
     # Load a specific image from a specific rectangle
     def image_at(self, rectangle, colorkey = None):
@@ -110,6 +874,130 @@ class Spritesheet(object):
             mirrored_images.append(pygame.transform.flip(images_list[i], flipX, flipY))
         return mirrored_images
 
+# Sprite assets
+class AssetManager(object):
+    """ Loads, slices, scales and mirrors each spritesheet once per process
+    and shares the frames between every sprite that uses them.
+    With use_atlas set, the finished frames are also saved next to the sheet
+    as a pre-baked atlas (<sheet>.atlas.png plus a .json index) so a cold
+    start only has to load and slice the atlas. The atlas is rebuilt when the
+    sheet is newer or the strip layout changed. """
+    def __init__(self, use_atlas=False):
+        self.use_atlas = use_atlas
+        self.strips = {}
+        self.masks = {}
+        self.solid_masks = {}
+        # frame -> (load_strips arguments, strip name, mirrored, index), for scaled_frame()
+        self.frame_sources = {}
+
+    def load_strips(self, filename, strips, colorkey, size):
+        """ strips is a sequence of (name, rects). Returns a dict mapping each
+        name to a (frames, mirrored_frames) tuple of frames scaled to size. """
+        key = (filename, tuple((name, tuple(rects)) for name, rects in strips), tuple(colorkey), tuple(size))
+        if key not in self.strips:
+            loaded = None
+            if self.use_atlas:
+                loaded = self.load_atlas(filename, strips, colorkey, size)
+            if loaded is None:
+                loaded = self.build_strips(filename, strips, colorkey, size)
+                if self.use_atlas:
+                    self.save_atlas(filename, strips, colorkey, size, loaded)
+            # collision masks are built here once, never while playing
+            for name, (frames, mirrored) in loaded.items():
+                for side, side_frames in enumerate((frames, mirrored)):
+                    for index, frame in enumerate(side_frames):
+                        self.masks[frame] = pygame.mask.from_surface(frame)
+                        self.frame_sources[frame] = ((filename, strips, colorkey, size), name, side, index)
+            self.strips[key] = loaded
+        return self.strips[key]
+
+    def scaled_frame(self, image, scale):
+        """ A strip frame as it comes out of the sheet at 1/scale of its
+        size, for drawing to a smaller render target without scaling the
+        full-size frame down again. None if image is not a strip frame.
+        These frames are display only: no masks and never saved to the atlas. """
+        source = self.frame_sources.get(image)
+        if source is None:
+            return None
+        (filename, strips, colorkey, size), name, side, index = source
+        size = (max(size[0] // scale, 1), max(size[1] // scale, 1))
+        key = (filename, tuple((name, tuple(rects)) for name, rects in strips), tuple(colorkey), size)
+        if key not in self.strips:
+            self.strips[key] = self.build_strips(filename, strips, colorkey, size)
+        return self.strips[key][name][side][index]
+
+    def mask(self, image):
+        """ The collision mask of a frame (its pixels that are not colour key),
+        shared by every sprite showing that frame. """
+        mask = self.masks.get(image)
+        if mask is None:
+            mask = self.masks[image] = pygame.mask.from_surface(image)
+        return mask
+
+    def solid_mask(self, size):
+        """ A fully set mask of size, for testing masks against rects. """
+        mask = self.solid_masks.get(size)
+        if mask is None:
+            mask = self.solid_masks[size] = pygame.mask.Mask(size, fill=True)
+        return mask
+
+    def build_strips(self, filename, strips, colorkey, size):
+        spritesheet = Spritesheet(filename)
+        loaded = {}
+        for name, rects in strips:
+            frames = spritesheet.images_at(rects, colorkey=colorkey)
+            frames = spritesheet.scale_images(frames, size[0], size[1])
+            loaded[name] = (frames, spritesheet.mirror_images(frames, True, False))
+        return loaded
+
+    def atlas_paths(self, filename):
+        return filename + '.atlas.png', filename + '.atlas.json'
+
+    def atlas_index(self, filename, strips, colorkey, size):
+        return {'sheet_mtime': os.path.getmtime(filename),
+                'strips': [[name, [list(rect) for rect in rects]] for name, rects in strips],
+                'colorkey': list(colorkey), 'size': list(size)}
+
+    def save_atlas(self, filename, strips, colorkey, size, loaded):
+        """ One atlas row per strip: the frames followed by the mirrored frames. """
+        image_path, index_path = self.atlas_paths(filename)
+        width = max(len(rects) for name, rects in strips) * 2 * size[0]
+        atlas = pygame.Surface([width, len(strips) * size[1]])
+        atlas.fill(colorkey)
+        for row, (name, rects) in enumerate(strips):
+            frames, mirrored = loaded[name]
+            for column, frame in enumerate(frames + mirrored):
+                atlas.blit(frame, (column * size[0], row * size[1]))
+        try:
+            pygame.image.save(atlas, image_path)
+            with open(index_path, 'w') as index_file:
+                json.dump(self.atlas_index(filename, strips, colorkey, size), index_file)
+        except (pygame.error, OSError) as message:
+            assets_log.warning("failed to save atlas %s: %s", image_path, message)
+
+    def load_atlas(self, filename, strips, colorkey, size):
+        """ Returns the strips from a matching atlas, or None if it is missing or stale. """
+        image_path, index_path = self.atlas_paths(filename)
+        try:
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+            if index != self.atlas_index(filename, strips, colorkey, size):
+                return None
+            atlas = pygame.image.load(image_path).convert()
+        except (pygame.error, OSError, ValueError):
+            return None
+        loaded = {}
+        for row, (name, rects) in enumerate(strips):
+            frames = []
+            for column in range(len(rects) * 2):
+                frame = atlas.subsurface((column * size[0], row * size[1], size[0], size[1])).copy()
+                frame.set_colorkey(colorkey, pygame.RLEACCEL)
+                frames.append(frame)
+            loaded[name] = (frames[:len(rects)], frames[len(rects):])
+        return loaded
+
+asset_manager = AssetManager()
+
 class GravitySprite(pygame.sprite.Sprite):
     """ Abstract class that implements basic gravity.
     Note: hack implementation -- currently requires rect to be updated by change_y variable"""
@@ -126,7 +1014,56 @@ class GravitySprite(pygame.sprite.Sprite):
         else:
             self.change_y += .35
 
-class AmmoBox(GravitySprite):
+# Object pools
+class SpritePool(object):
+    """ Recycles sprite instances instead of leaving
+    killed sprites to the garbage collector. acquire() reuses a free sprite
+    by calling its reset() with the constructor arguments, or builds a new
+    one; PooledSprite.kill() hands the sprite back. An acquired sprite has no
+    previous_pos, so it is never interpolated from where it last died. """
+    def __init__(self, sprite_class):
+        self.sprite_class = sprite_class
+        self.free = []
+        self.live = 0
+        self.high_water = 0
+        self.created = 0
+
+    def acquire(self, *args):
+        if self.free:
+            sprite = self.free.pop()
+            sprite.reset(*args)
+        else:
+            sprite = self.sprite_class(*args)
+            self.created += 1
+        sprite.pool = self
+        sprite.previous_pos = None
+        self.live += 1
+        if self.live > self.high_water:
+            self.high_water = self.live
+        return sprite
+
+    def release(self, sprite):
+        self.live -= 1
+        self.free.append(sprite)
+
+    def stats(self):
+        """ Returns the live, free, high-water and created counts. """
+        return {'live': self.live, 'free': len(self.free), 'high_water': self.high_water, 'created': self.created}
+
+
+class PooledSprite(pygame.sprite.Sprite):
+    """ Sprite that returns to the SpritePool it was acquired from when killed. """
+    pool = None
+
+    def kill(self):
+        super().kill()
+        if self.pool is not None:
+            pool = self.pool
+            self.pool = None # a second kill must not release twice
+            pool.release(self)
+
+
+class AmmoBox(PooledSprite, GravitySprite):
     """ Ammobox item that adds ammo to planePlayer """
 
     # --- AmmoBox constants ---
@@ -134,22 +1071,32 @@ class AmmoBox(GravitySprite):
     AMMOBOX_WIDTH = 20
     AMMOBOX_HEIGHT = 8
 
-    def __init__(self, pos, platform_list):
+    def __init__(self, pos, tile_map):
         """Constructor, create ammobox image."""
         super().__init__()
-        self.image = pygame.Surface([self.AMMOBOX_WIDTH, self.AMMOBOX_HEIGHT])
-        self.image.fill(self.AMMOBOX_COLOR)
+        self.image = image_cache.get([self.AMMOBOX_WIDTH, self.AMMOBOX_HEIGHT], self.AMMOBOX_COLOR)
         self.rect = self.image.get_rect()
+        self.reset(pos, tile_map)
 
+    def reset(self, pos, tile_map):
+        """ (Re)initialise the box state; used by the constructor and the pool. """
         self.rect.center = pos
-        self.platform_list = platform_list
+        self.tile_map = tile_map
 
         #speed vectors
         self.change_x = 0
+        self.change_y = 0
+
+    def get_state(self):
+        return (tuple(self.rect), self.change_x, self.change_y)
+
+    def set_state(self, state):
+        rect, self.change_x, self.change_y = state
+        self.rect.topleft = rect[:2]
 
     def activate(self, player):
-        print("bonus ammo!")
-        audioSystem.play(SOUNDS.PICKUP_AMMO)
+        pickup_log.info("bonus ammo!")
+        AudioLocator.get().play(SOUNDS.PICKUP_AMMO)
         player.addAmmo(10)
 
     def update(self):
@@ -157,7 +1104,7 @@ class AmmoBox(GravitySprite):
         if self.rect.top > SCREEN_HEIGHT:
             self.kill()
             # debug
-            print("box is gone and this should only appear once")
+            pickup_log.debug("box is gone and this should only appear once")
 
 
         self.calc_gravity()
@@ -166,18 +1113,18 @@ class AmmoBox(GravitySprite):
         self.rect.y += self.change_y
 
         # vertical collision check
-        block_hit_list = pygame.sprite.spritecollide(self, self.platform_list, False)
-        for block in block_hit_list:
+        tile_hit_list = self.tile_map.solid_rects(self.rect)
+        for tile in tile_hit_list:
             # Reset position based on the top/bottom of object
             if self.change_y > 0:
-                self.rect.bottom = block.rect.top
+                self.rect.bottom = tile.top
             elif self.change_y < 0:
-                self.rect.top = block.rect.bottom
+                self.rect.top = tile.bottom
 
             self.change_y = 0
 
 
-class Bullet(pygame.sprite.Sprite):
+class Bullet(PooledSprite):
     """ Bullets fired by players to destroy blocks."""
 
     # --- Bullet constants ---
@@ -190,46 +1137,62 @@ class Bullet(pygame.sprite.Sprite):
     def __init__(self, pos):
         """Constructor, create image of bullet. """
         super().__init__()
-        self.image = pygame.Surface([self.BULLET_WIDTH, self.BULLET_HEIGHT])
-        self.image.fill(self.BULLET_COLOR)
+        self.image = image_cache.get([self.BULLET_WIDTH, self.BULLET_HEIGHT], self.BULLET_COLOR)
         self.rect = self.image.get_rect()
+        self.reset(pos)
 
+    def reset(self, pos):
+        """ Place the bullet; used by the constructor and the pool. """
         self.rect.center = pos
 
         # debug message
-        print("new bullet at " + str(self.rect.center))
+        bullet_log.debug("new bullet at %s", self.rect.center)
+
+    def get_state(self):
+        return tuple(self.rect)
 
+    def set_state(self, state):
+        self.rect.topleft = state[:2]
 
     def update(self):
         if self.rect.bottom < 0:
             self.kill()
             # debug message
-            print("gone and you should only see this once per shot")
+            bullet_log.debug("gone and you should only see this once per shot")
         else:
             self.rect.y -= self.BULLET_SPEED
 
 
 
 
-class Block(GravitySprite):
+class Block(PooledSprite, GravitySprite):
     """ This class represents a falling block. """
     # --- Block constants ---
     PAYLOADS = ['bomb', 'fuel']
+    PAYLOAD_COLORS = {None: BLACK, 'bomb': RED, 'fuel': GREEN}
     BLOCK_WIDTH = 20
     BLOCK_HEIGHT = 20
 
-    def __init__(self):
+    def __init__(self, rng=random, camera=None, wave_scale=1.0):
         """ Constructor, create the image of the block. """
         super().__init__()
-        self.image = pygame.Surface([self.BLOCK_WIDTH, self.BLOCK_HEIGHT])
-        self.image.fill(BLACK)
+        self.image = image_cache.get([self.BLOCK_WIDTH, self.BLOCK_HEIGHT], BLACK)
         self.rect = self.image.get_rect()
-
+        self.reset(rng, camera, wave_scale)
+
+    def reset(self, rng=random, camera=None, wave_scale=1.0):
+        """ (Re)initialise payload, fall behaviour and speed; used by the
+        constructor and the pool. The block respawns above the camera's view,
+        in a band 1/wave_scale times as tall (see Game.wave_scale). """
+        self.rng = rng
+        self.camera = camera
+        self.wave_scale = wave_scale
         self.set_payload()
         self.set_fallBehavior()
 
         #speed vectors
         self.change_x = 0
+        self.change_y = 0
 
     def set_fallBehavior(self):
         # assigns fall() to a fallBehavior
@@ -237,7 +1200,7 @@ class Block(GravitySprite):
 
         #### TESTING ####
         ## mixed fall types ##
-        if random.randint(1,100) > 95:
+        if self.rng.randint(1,100) > 95:
             self.fall = self.basicGravityFallBehavior
         ### END TEST ####
 
@@ -261,34 +1224,254 @@ class Block(GravitySprite):
 
     def set_payload(self):
         "determine what the box contains"
-        if random.randint(1,100) > 50:
-            self.payload = random.choice(self.PAYLOADS)
+        if self.rng.randint(1,100) > 50:
+            self.payload = self.rng.choice(self.PAYLOADS)
             if self.payload == 'bomb':
-                self.image.fill(RED)
+                self.image = image_cache.get([self.BLOCK_WIDTH, self.BLOCK_HEIGHT], RED)
             if self.payload == 'fuel':
-                self.image.fill(GREEN)
+                self.image = image_cache.get([self.BLOCK_WIDTH, self.BLOCK_HEIGHT], GREEN)
         else:
             self.payload = None
-            self.image.fill(BLACK)
+            self.image = image_cache.get([self.BLOCK_WIDTH, self.BLOCK_HEIGHT], BLACK)
 
     def reset_pos(self):
         """ Called when the block is 'collected' or falls off
         the screen. """
-        self.rect.y = random.randrange(-300, -20)
-        self.rect.x = random.randrange(SCREEN_WIDTH)
+        self.rect.y = self.rng.randrange(-300, -20)
+        if self.wave_scale != 1.0:
+            self.rect.y = int((self.rect.y + 20) / self.wave_scale) - 20
+        self.rect.x = self.rng.randrange(SCREEN_WIDTH) + (self.camera.x if self.camera is not None else 0)
         self.set_payload()
 
-    def drop(self, groups, platform_list):
+    def drop(self, groups, tile_map):
         if self.payload == 'fuel':
-            print("pickup dropped")
-            p = AmmoBox(self.rect.center, platform_list)
+            block_log.debug("pickup dropped")
+            p = ammobox_pool.acquire(self.rect.center, tile_map)
             for group in groups:
                 group.add(p)
 
+    def crash(self, tile_map):
+        """ Destroys the level tiles the block is overlapping.
+        Returns the number of tiles destroyed. """
+        return tile_map.destroy_rect(self.rect)
+
+    def get_state(self):
+        """ Position, payload, speed and which fall strategy is selected. """
+        return (tuple(self.rect), self.payload, self.change_x, self.change_y,
+                self.fall == self.basicGravityFallBehavior)
+
+    def set_state(self, state):
+        rect, self.payload, self.change_x, self.change_y, gravity = state
+        self.rect.topleft = rect[:2]
+        self.image = image_cache.get([self.BLOCK_WIDTH, self.BLOCK_HEIGHT], self.PAYLOAD_COLORS[self.payload])
+        self.fall = self.basicGravityFallBehavior if gravity else self.linearFallBehavior
+
     def update(self):
         """ Automatically called when we need to move the block. """
         self.fall() # calls the fall strategy selected on creation
 
+class BlockSwarm(object):
+    """ The "ore storm": thousands of falling blocks with the same rules as
+    Block, kept in NumPy arrays (position, fall speed, payload, fall behaviour
+    and alive flag) and moved with one vectorised step per frame. Collisions
+    are batched per bullet/player rect and the blocks are drawn with a single
+    Surface.blits call. Destroyed blocks stay dead, as Block sprites do. """
+    # payload codes; 1.. follow Block.PAYLOADS
+    PAYLOAD_NONE = 0
+    PAYLOAD_BOMB = 1
+    PAYLOAD_FUEL = 2
+    PAYLOAD_COLORS = (BLACK, RED, GREEN)
+
+    def __init__(self, count, rng=random, camera=None):
+        if numpy is None:
+            raise UserWarning("The block swarm needs NumPy installed.")
+        self.size = count
+        # blocks respawn above the camera's view and are drawn relative to it
+        self.camera = camera if camera is not None else Camera()
+        self.width = Block.BLOCK_WIDTH
+        self.height = Block.BLOCK_HEIGHT
+        self.wave_scale = 1.0 # as Game.wave_scale
+        self.reset(rng)
+
+    def reset(self, rng=random):
+        """ Scatter a fresh set of blocks, as Game does for Block sprites. """
+        count = self.size
+        self.np_rng = numpy.random.default_rng(rng.randrange(2**32))
+        self.x = self.np_rng.integers(0, SCREEN_WIDTH, count) + self.camera.x
+        self.y = self.np_rng.integers(-300, SCREEN_HEIGHT, count)
+        self.change_y = numpy.zeros(count)
+        # same odds as Block.set_fallBehavior
+        self.gravity = self.np_rng.integers(1, 101, count) > 95
+        self.payload = self.random_payloads(count)
+        self.alive = numpy.ones(count, dtype=bool)
+        # position before the last update and blend factor, for render interpolation
+        self.previous_y = self.y.copy()
+        self.alpha = None
+
+    def get_state(self):
+        """ Copies of the block arrays and the generator state. """
+        return (self.x.copy(), self.y.copy(), self.change_y.copy(), self.gravity.copy(), self.payload.copy(),
+                self.alive.copy(), self.previous_y.copy(), self.np_rng.bit_generator.state)
+
+    def set_state(self, state):
+        arrays = (self.x, self.y, self.change_y, self.gravity, self.payload, self.alive, self.previous_y)
+        for array, saved in zip(arrays, state):
+            array[:] = saved
+        self.np_rng.bit_generator.state = state[-1]
+
+    def random_payloads(self, count):
+        """ Same odds as Block.set_payload. """
+        has_payload = self.np_rng.integers(1, 101, count) > 50
+        kind = self.np_rng.integers(1, len(Block.PAYLOADS) + 1, count)
+        return numpy.where(has_payload, kind, self.PAYLOAD_NONE).astype(numpy.int8)
+
+    def count(self):
+        return int(numpy.count_nonzero(self.alive))
+
+    def reset_pos(self, mask):
+        """ Block.reset_pos for every block in mask. """
+        count = int(numpy.count_nonzero(mask))
+        y = self.np_rng.integers(-300, -20, count)
+        if self.wave_scale != 1.0:
+            y = ((y + 20) / self.wave_scale).astype(y.dtype) - 20
+        self.y[mask] = y
+        self.x[mask] = self.np_rng.integers(0, SCREEN_WIDTH, count) + self.camera.x
+        self.payload[mask] = self.random_payloads(count)
+
+    def update(self):
+        """ One step of linearFallBehavior / basicGravityFallBehavior for every block. """
+        limit = SCREEN_HEIGHT + self.height
+        self.previous_y[:] = self.y
+        linear = self.alive & ~self.gravity
+        self.y[linear] += 1
+        reset = linear & (self.y > limit)
+
+        falling = self.alive & self.gravity
+        change_y = self.change_y[falling]
+        self.change_y[falling] = numpy.where(change_y == 0, 1, change_y + .35)
+        cleared = falling & (self.y > limit)
+        self.change_y[cleared] = 0
+        reset |= cleared
+        if reset.any():
+            self.reset_pos(reset)
+
+        # Rect.y rounds half away from zero when given a float
+        moved = self.y[falling] + self.change_y[falling]
+        self.y[falling] = numpy.trunc(moved + numpy.copysign(.5, moved))
+
+    def overlap(self, rect):
+        """ Mask of live blocks whose rect collides with rect. """
+        return (self.alive & (self.x < rect.right) & (self.x + self.width > rect.left)
+                & (self.y < rect.bottom) & (self.y + self.height > rect.top))
+
+    def rect(self, index):
+        return pygame.Rect(int(self.x[index]), int(self.y[index]), self.width, self.height)
+
+    def hits(self, rect, collided=None):
+        """ True if a live block touches rect. collided(block_rect) refines
+        the test for the blocks whose rects overlap. """
+        mask = self.overlap(rect)
+        if collided is None:
+            return bool(mask.any())
+        return any(collided(self.rect(index)) for index in numpy.flatnonzero(mask).tolist())
+
+    def collect(self, rect):
+        """ Kills the blocks touching rect. Returns how many there were. """
+        mask = self.overlap(rect)
+        self.alive[mask] = False
+        return int(numpy.count_nonzero(mask))
+
+    def shoot(self, bullet_list):
+        """ Same outcome as groupcollide(blocks, bullets, True, True): blocks are
+        resolved in order and a bullet is used up by the first block it hits.
+        Returns the indices of the destroyed blocks. """
+        hits = {}
+        for bullet in bullet_list:
+            for index in numpy.flatnonzero(self.overlap(bullet.rect)).tolist():
+                hits.setdefault(index, []).append(bullet)
+        destroyed = []
+        for index in sorted(hits):
+            bullets = [bullet for bullet in hits[index] if bullet.alive()]
+            if bullets:
+                for bullet in bullets:
+                    bullet.kill()
+                self.alive[index] = False
+                destroyed.append(index)
+        return destroyed
+
+    def drop(self, index, groups, tile_map):
+        """ Block.drop for the block at index. """
+        if self.payload[index] == self.PAYLOAD_FUEL:
+            block_log.debug("pickup dropped")
+            center = (int(self.x[index]) + self.width // 2, int(self.y[index]) + self.height // 2)
+            p = ammobox_pool.acquire(center, tile_map)
+            for group in groups:
+                group.add(p)
+
+    def crash(self, tile_map, crashed=None):
+        """ Block.crash for every live block. The tiles under each block are
+        looked up in a NumPy view of the tile map first, so only blocks that
+        actually touch a solid tile go through TileMap.destroy_rect. If given,
+        crashed gets a (rect, tiles destroyed) pair for each block that broke tiles.
+        Blocks still above the first solid row are dropped before the lookup,
+        so most ticks only a handful of blocks are indexed. """
+        first_solid = tile_map.tiles.find(TileMap.SOLID)
+        if first_solid < 0:
+            return 0
+        size = tile_map.tile_size
+        top_row_y = tile_map.y + first_solid // tile_map.columns * size
+        near = numpy.flatnonzero(self.alive & (self.y + self.height > top_row_y))
+        if not len(near):
+            return 0
+        tiles = numpy.frombuffer(tile_map.tiles, dtype=numpy.uint8).reshape(tile_map.rows, tile_map.columns)
+        x = self.x[near]
+        y = self.y[near]
+        left = (x - tile_map.x) // size
+        right = (x + self.width - 1 - tile_map.x) // size
+        top = (y - tile_map.y) // size
+        bottom = (y + self.height - 1 - tile_map.y) // size
+        candidates = (right >= 0) & (left < tile_map.columns) & (bottom >= 0) & (top < tile_map.rows)
+        touching = numpy.zeros_like(candidates)
+        for dy in range((self.height - 1) // size + 2):
+            for dx in range((self.width - 1) // size + 2):
+                column = left + dx
+                row = top + dy
+                valid = (candidates & (column <= right) & (row <= bottom) & (column >= 0)
+                         & (column < tile_map.columns) & (row >= 0) & (row < tile_map.rows))
+                touching[valid] |= tiles[row[valid], column[valid]] == TileMap.SOLID
+        destroyed = 0
+        for index in near[touching].tolist():
+            rect = self.rect(index)
+            tiles = tile_map.destroy_rect(rect)
+            if tiles and crashed is not None:
+                crashed.append((rect, tiles))
+            destroyed += tiles
+        return destroyed
+
+    def draw(self, screen):
+        """ Draws the visible blocks with one blits call. Returns the drawn rects. """
+        return screen.blits(self.commands(screen.get_size()))
+
+    def commands(self, size):
+        """ (image, position) of each block visible on a screen of size. """
+        images = [image_cache.get([self.width, self.height], color) for color in self.PAYLOAD_COLORS]
+        y = self.y
+        if self.alpha is not None:
+            # blend from the previous position unless the block was reset
+            step = self.y - self.previous_y
+            y = numpy.where(numpy.abs(step) > INTERPOLATION_MAX_DISTANCE, self.y,
+                            self.previous_y + (step * self.alpha).astype(self.y.dtype))
+        x = self.x - self.camera.x
+        visible = numpy.flatnonzero(self.alive & (y > -self.height) & (y < size[1])
+                                    & (x > -self.width) & (x < size[0]))
+        return [(images[payload], (x, y)) for payload, x, y in
+                zip(self.payload[visible].tolist(), x[visible].tolist(), y[visible].tolist())]
+
+# shared pools for the short-lived sprites
+bullet_pool = SpritePool(Bullet)
+ammobox_pool = SpritePool(AmmoBox)
+block_pool = SpritePool(Block)
+
 class PlanePlayer(pygame.sprite.Sprite):
     """ This class represents the player in control of the aircraft. """
 
@@ -299,33 +1482,47 @@ class PlanePlayer(pygame.sprite.Sprite):
 
     RECOIL_DISTANCE = 10
 
-    def __init__(self):
+    def __init__(self, input_source, camera=None):
+        """ The input's mouse position is on screen; camera maps it into the world. """
         super().__init__()
-        self.image = pygame.Surface([self.PLANE_WIDTH, self.PLANE_HEIGHT])
-        self.image.fill(RED)
+        self.input = input_source
+        self.camera = camera if camera is not None else Camera()
+        self.image = image_cache.get([self.PLANE_WIDTH, self.PLANE_HEIGHT], RED)
         self.rect = self.image.get_rect()
+        self.reset()
+
+    def reset(self):
+        """ Back to the starting ammo and position for a new game. """
+        self.rect.topleft = (0, 0)
         self.ammo = self.PLANE_AMMO
 
         self.offset_x = 0;
         self.offset_y = 0;
 
+    def get_state(self):
+        return (tuple(self.rect), self.ammo, self.offset_x, self.offset_y)
+
+    def set_state(self, state):
+        rect, self.ammo, self.offset_x, self.offset_y = state
+        self.rect.topleft = rect[:2]
+
     def fire(self, groups):
 
         if self.ammo > 0:
             # play sfx
-            # TODO -- configure AudioLocator to play sound
-            audioSystem.play(SOUNDS.PLANE_FIRE)
+            AudioLocator.get().play(SOUNDS.PLANE_FIRE)
             # expend ammo
             self.ammo -= 1
-            print("fire! bullets remaining: " + str(self.ammo))
+            plane_log.debug("fire! bullets remaining: %d", self.ammo)
             # create a new bullet and add to appropriate Sprite groups
-            b = Bullet(pygame.mouse.get_pos())
+            pos = self.input.get_pos()
+            b = bullet_pool.acquire((pos[0] + self.camera.x, pos[1]))
             for group in groups:
                 group.add(b)
             # recoil from shot
             self.recoil()
         else:
-            print("out of ammo!")
+            plane_log.info("out of ammo!")
 
     def addAmmo(self, num):
         self.ammo += num
@@ -335,8 +1532,8 @@ class PlanePlayer(pygame.sprite.Sprite):
 
     def update(self):
         """ Update the player location. """
-        pos = pygame.mouse.get_pos()
-        adjustedPos = (pos[0], pos[1] + self.offset_y)
+        pos = self.input.get_pos()
+        adjustedPos = (pos[0] + self.camera.x, pos[1] + self.offset_y)
         self.rect.center = adjustedPos
 
         if self.offset_y > 0:
@@ -358,25 +1555,45 @@ class GroundPlayer(GravitySprite):
     PLAYER_SPRITESHEET_PATH = 'data'
     PLAYER_COLORKEY = (157, 142, 135)
     ANIMATION_FRAMEDELAY = 10
+    # spritesheet rects of each animation strip (16x16 frames)
+    PLAYER_STRIPS = (
+        ('running', ((17, 32, 16, 16), (33, 32, 16, 16), (49, 32, 16, 16), (65, 32, 16, 16), (81, 32, 16, 16), (97, 32, 16, 16))),
+        ('standing', ((17, 16, 16, 16), (33, 16, 16, 16), (49, 16, 16, 16), (65, 16, 16, 16))),
+        ('jumping', ((17, 48, 16, 16),)),
+        ('falling', ((33, 48, 16, 16),)),
+    )
     ANIM_STATES = Enum('ANIM_STATES', 'ONGROUND JUMPING FALLING STANDING')
     ANIM_DIRECTIONS = Enum('ANIM_DIRECTIONS', 'LEFT RIGHT')
+    # attributes holding the animation frame lists, for get_state()
+    IMAGE_LISTS = ('images_right', 'images_left', 'images_standing_right', 'images_standing_left',
+                   'images_jumping_right', 'images_jumping_left', 'images_falling_right', 'images_falling_left')
 
-    # list of sprites that block movement
+    # level whose tile map blocks movement
     level = None
 
     def __init__(self):
         super().__init__()
 
-        self.loadPlayerImages(Spritesheet(os.path.join(self.PLAYER_SPRITESHEET_PATH, self.PLAYER_SPRITESHEET_FILENAME)))
+        self.loadPlayerImages(asset_manager.load_strips(os.path.join(self.PLAYER_SPRITESHEET_PATH, self.PLAYER_SPRITESHEET_FILENAME),
+                                                        self.PLAYER_STRIPS, self.PLAYER_COLORKEY, (self.PLAYER_WIDTH, self.PLAYER_HEIGHT)))
         self.image = self.images_standing_right[0] # initial image for height/width (arbitrary)
         self.rect = self.image.get_rect()
+        self.reset()
+
+    @property
+    def mask(self):
+        """ Pixel mask of the current frame, for collide_mask_rect(). """
+        return asset_manager.mask(self.image)
+
+    def reset(self):
+        """ Back to the starting position and animation for a new game. """
+        self.image = self.images_standing_right[0]
+        self.rect.topleft = (0, 0)
 
         # set speed vectors
         self.change_x = 0
         self.change_y = 0
 
-
-    def loadPlayerImages(self, spritesheet):
         # initialize animation variables
         self.playerAnimationState = None
         self.playerDirectionState = None
@@ -384,30 +1601,49 @@ class GroundPlayer(GravitySprite):
         self.animation_index = 0
         self.animation_delay = 0
 
-        # load Running images
-        self.images_right = spritesheet.images_at([(17, 32, 16, 16), (33, 32, 16, 16), (49, 32, 16, 16), (65, 32, 16, 16), (81, 32, 16, 16), (97, 32, 16, 16)], colorkey=self.PLAYER_COLORKEY)
-        self.images_right = spritesheet.scale_images(self.images_right, self.PLAYER_WIDTH, self.PLAYER_HEIGHT)
-        self.images_left = spritesheet.mirror_images(self.images_right, True, False)
-
-        # load Standing images
-        self.images_standing_right = spritesheet.images_at([(17, 16, 16, 16), (33, 16, 16, 16), (49, 16, 16, 16), (65, 16, 16, 16)], colorkey=self.PLAYER_COLORKEY)
-        self.images_standing_right = spritesheet.scale_images(self.images_standing_right, self.PLAYER_WIDTH, self.PLAYER_HEIGHT)
+    def find_image(self, image):
+        """ Returns the (list name, index) of an animation frame. """
+        for name in self.IMAGE_LISTS:
+            for index, frame in enumerate(getattr(self, name)):
+                if frame is image:
+                    return name, index
+        return None
+
+    def get_state(self):
+        """ Position, speed and animation state; the frame lists are
+        referred to by attribute name instead of by surface. """
+        images_list = None
+        if self.current_images_list is not None:
+            images_list = next(name for name in self.IMAGE_LISTS if getattr(self, name) is self.current_images_list)
+        return (tuple(self.rect), self.change_x, self.change_y, self.playerAnimationState, self.playerDirectionState,
+                images_list, self.animation_index, self.animation_delay, self.find_image(self.image))
+
+    def set_state(self, state):
+        (rect, self.change_x, self.change_y, self.playerAnimationState, self.playerDirectionState,
+         images_list, self.animation_index, self.animation_delay, image) = state
+        self.rect.topleft = rect[:2]
+        self.current_images_list = getattr(self, images_list) if images_list is not None else None
+        name, index = image
+        self.image = getattr(self, name)[index]
+
+    def loadPlayerImages(self, strips):
+        # Running images
+        self.images_right, self.images_left = strips['running']
+
+        # Standing images
+        standing_right, standing_left = strips['standing']
         # arrange the Standing images to include an occasional blinking frame
-        self.blink_image = self.images_standing_right[3]
-        self.images_standing_right = (self.images_standing_right[:3] + self.images_standing_right[1:2]) * 3
+        self.blink_image = standing_right[3]
+        self.images_standing_right = (standing_right[:3] + standing_right[1:2]) * 3
         self.images_standing_right.append(self.blink_image)
-        # copy to left facing strip
-        self.images_standing_left = spritesheet.mirror_images(self.images_standing_right, True, False)
+        self.images_standing_left = (standing_left[:3] + standing_left[1:2]) * 3
+        self.images_standing_left.append(standing_left[3])
 
-        # load Jumping images
-        self.images_jumping_right = spritesheet.images_at([(17, 48, 16, 16)], colorkey=self.PLAYER_COLORKEY)
-        self.images_jumping_right = spritesheet.scale_images(self.images_jumping_right, self.PLAYER_WIDTH, self.PLAYER_HEIGHT)
-        self.images_jumping_left = spritesheet.mirror_images(self.images_jumping_right, True, False)
+        # Jumping images
+        self.images_jumping_right, self.images_jumping_left = strips['jumping']
 
-        # load Falling images
-        self.images_falling_right = spritesheet.images_at([(33, 48, 16, 16)], colorkey=self.PLAYER_COLORKEY)
-        self.images_falling_right = spritesheet.scale_images(self.images_falling_right, self.PLAYER_WIDTH, self.PLAYER_HEIGHT)
-        self.images_falling_left = spritesheet.mirror_images(self.images_falling_right, True, False)
+        # Falling images
+        self.images_falling_right, self.images_falling_left = strips['falling']
 
     def updatePlayerImage(self):
         # display image and advance index
@@ -425,12 +1661,12 @@ class GroundPlayer(GravitySprite):
         """update the player state if it's new"""
         #assert(playerAnimationState
         if self.playerAnimationState != playerAnimationState:
-            print("DEBUG: state mismatch! " + str(self.playerAnimationState) + " does not equal " + str(playerAnimationState))
+            player_log.debug("state mismatch! %s does not equal %s", self.playerAnimationState, playerAnimationState)
             self.playerAnimationState = playerAnimationState
             self.setCurrentImagesList(playerAnimationState, playerDirectionState)
 
         if self.playerDirectionState != playerDirectionState:
-            print("DEBUG: direction mismatch! " + str(self.playerDirectionState) + " does not equal " + str(playerDirectionState))
+            player_log.debug("direction mismatch! %s does not equal %s", self.playerDirectionState, playerDirectionState)
             self.playerDirectionState = playerDirectionState
             self.setCurrentImagesList(playerAnimationState, playerDirectionState)
 
@@ -475,27 +1711,30 @@ class GroundPlayer(GravitySprite):
 
         # move left/right
         self.rect.x += self.change_x
+        # the world starts at x = 0
+        if self.rect.left < 0:
+            self.rect.left = 0
 
         # collision check
-        block_hit_list = pygame.sprite.spritecollide(self, self.level.platform_list, False)
-        for block in block_hit_list:
+        tile_hit_list = self.level.tile_map.solid_rects(self.rect)
+        for tile in tile_hit_list:
             # If moving right, set right side to the left side of item
             if self.change_x > 0:
-                self.rect.right = block.rect.left
+                self.rect.right = tile.left
             elif self.change_x < 0:
-                self.rect.left = block.rect.right
+                self.rect.left = tile.right
 
         # move up/down
         self.rect.y += self.change_y
 
         # vertical collision check
-        block_hit_list = pygame.sprite.spritecollide(self, self.level.platform_list, False)
-        for block in block_hit_list:
+        tile_hit_list = self.level.tile_map.solid_rects(self.rect)
+        for tile in tile_hit_list:
             # Reset position based on the top/bottom of object
             if self.change_y > 0:
-                self.rect.bottom = block.rect.top
+                self.rect.bottom = tile.top
             elif self.change_y < 0:
-                self.rect.top = block.rect.bottom
+                self.rect.top = tile.bottom
 
             self.change_y = 0
 
@@ -515,10 +1754,10 @@ class GroundPlayer(GravitySprite):
 
         # temporarily move down to check if there is a platform to jump from (no air jumps)
         self.rect.y += 2 # works better with two pixels
-        platform_hit_list = pygame.sprite.spritecollide(self, self.level.platform_list, False)
+        on_ground = self.level.tile_map.any_solid(self.rect)
         self.rect.y -= 2
 
-        if len(platform_hit_list) > 0 or self.rect.bottom >= SCREEN_HEIGHT:
+        if on_ground or self.rect.bottom >= SCREEN_HEIGHT:
             self.change_y = -self.PLAYER_JUMP_HEIGHT
 
     def go_left(self):
@@ -563,104 +1802,1469 @@ class GroundPlayer(GravitySprite):
         self.setPlayerAnimationState(animationState, directionState)
 
 
-class Platform(pygame.sprite.Sprite):
-    """ Platform the user can jump on """
-    def __init__(self, width, height):
-        """ Platform constructor. Assumes constructed with user passing in
-        an array of 5 numbers like what's defined at the top of this code.
-        """
-        super().__init__()
-        self.image = pygame.Surface([width, height])
-        self.image.fill(GREEN)
-        self.rect = self.image.get_rect()
+class Camera(object):
+    """ Horizontal view onto the world: a sprite at world x is drawn at
+    x - camera.x. Scrolling only moves the camera, never the world's rects.
+    follow() keeps a rect inside the middle band of the screen. """
+    LEFT_EDGE = SCREEN_WIDTH // 3
+    RIGHT_EDGE = SCREEN_WIDTH * 2 // 3
+
+    def __init__(self):
+        self.x = 0
+
+    def follow(self, rect):
+        if rect.right - self.x > self.RIGHT_EDGE:
+            self.x = rect.right - self.RIGHT_EDGE
+        elif rect.left - self.x < self.LEFT_EDGE:
+            self.x = max(rect.left - self.LEFT_EDGE, 0)
+
+    def apply(self, rect):
+        """ Returns the screen rect of a world rect. """
+        return rect.move(-self.x, 0)
+
+
+class TileMap(object):
+    """ Level geometry stored as a flat bytearray of tiles (0 = empty,
+    1 = solid) instead of one sprite per tile. Point and rect queries only
+    look at the tiles under the rect, and the map is drawn from one cached
+    surface per chunk of CHUNK_TILES x CHUNK_TILES tiles, rebuilt when a tile
+    in it changes. """
+    EMPTY = 0
+    SOLID = 1
+    CHUNK_TILES = 16
+    TILE_COLOR = GREEN
+    COLORKEY = (255, 0, 255)
+
+    def __init__(self, columns, rows, tile_size, x=0, y=0):
+        self.columns = columns
+        self.rows = rows
+        self.tile_size = tile_size
+        # pixel position of the top-left tile
+        self.x = x
+        self.y = y
+        self.tiles = bytearray(columns * rows)
+        self.chunk_surfaces = {}
+        # chunk surfaces are rendered at 1/render_scale size (see draw)
+        self.render_scale = 1
+
+    def stream(self, camera_x):
+        """ A fixed map has nothing to stream; see StreamedTileMap. """
+        return False
+
+    def clear(self):
+        """ Empties every tile in place. """
+        self.tiles[:] = bytes(len(self.tiles))
+        self.chunk_surfaces = {}
+
+    def get_state(self):
+        return (bytes(self.tiles), self.x, self.y)
+
+    def set_state(self, state):
+        """ Restores the tiles and position. Returns True if any tile changed. """
+        tiles, self.x, self.y = state
+        if self.tiles == tiles:
+            return False
+        self.tiles[:] = tiles
+        self.chunk_surfaces = {}
+        return True
+
+    def get_tile(self, column, row):
+        if 0 <= column < self.columns and 0 <= row < self.rows:
+            return self.tiles[row * self.columns + column]
+        return self.EMPTY
+
+    def set_tile(self, column, row, value):
+        self.tiles[row * self.columns + column] = value
+        # drop the cached chunk so it is rendered again
+        self.chunk_surfaces.pop((column // self.CHUNK_TILES, row // self.CHUNK_TILES), None)
+
+    def solid_at(self, x, y):
+        """ Is the pixel at x, y inside a solid tile? """
+        return self.get_tile((x - self.x) // self.tile_size, (y - self.y) // self.tile_size) == self.SOLID
+
+    def tile_range(self, rect):
+        """ Returns the columns and rows of the tiles a rect overlaps,
+        clipped to the map. """
+        size = self.tile_size
+        left = max((rect.left - self.x) // size, 0)
+        right = min((rect.right - 1 - self.x) // size, self.columns - 1)
+        top = max((rect.top - self.y) // size, 0)
+        bottom = min((rect.bottom - 1 - self.y) // size, self.rows - 1)
+        return range(left, right + 1), range(top, bottom + 1)
+
+    def tile_rect(self, column, row):
+        size = self.tile_size
+        return pygame.Rect(self.x + column * size, self.y + row * size, size, size)
+
+    def solid_rects(self, rect):
+        """ Returns the rects of the solid tiles overlapping rect, row by row. """
+        columns, rows = self.tile_range(rect)
+        tiles = self.tiles
+        hits = []
+        for row in rows:
+            offset = row * self.columns
+            for column in columns:
+                if tiles[offset + column] == self.SOLID:
+                    hits.append(self.tile_rect(column, row))
+        return hits
+
+    def any_solid(self, rect):
+        """ Does rect overlap any solid tile? """
+        columns, rows = self.tile_range(rect)
+        tiles = self.tiles
+        for row in rows:
+            offset = row * self.columns
+            for column in columns:
+                if tiles[offset + column] == self.SOLID:
+                    return True
+        return False
+
+    def destroy_rect(self, rect):
+        """ Clears the solid tiles overlapping rect. Returns how many were cleared. """
+        columns, rows = self.tile_range(rect)
+        destroyed = 0
+        for row in rows:
+            for column in columns:
+                if self.tiles[row * self.columns + column] == self.SOLID:
+                    self.set_tile(column, row, self.EMPTY)
+                    destroyed += 1
+        return destroyed
+
+    def render_chunk(self, chunk_x, chunk_y):
+        """ Renders one chunk to a surface, or returns None if it is empty. """
+        size = self.tile_size
+        first_column = chunk_x * self.CHUNK_TILES
+        first_row = chunk_y * self.CHUNK_TILES
+        columns = range(first_column, min(first_column + self.CHUNK_TILES, self.columns))
+        rows = range(first_row, min(first_row + self.CHUNK_TILES, self.rows))
+        surface = None
+        for row in rows:
+            for column in columns:
+                if self.tiles[row * self.columns + column] == self.SOLID:
+                    if surface is None:
+                        surface = pygame.Surface([len(columns) * size, len(rows) * size])
+                        if pygame.display.get_surface() is not None:
+                            surface = surface.convert()
+                        surface.fill(self.COLORKEY)
+                    surface.fill(self.TILE_COLOR, ((column - first_column) * size, (row - first_row) * size, size, size))
+        if surface is not None:
+            if self.render_scale != 1:
+                surface = pygame.transform.scale(surface, (surface.get_width() // self.render_scale,
+                                                           surface.get_height() // self.render_scale))
+            surface.set_colorkey(self.COLORKEY, pygame.RLEACCEL)
+        return surface
+
+    def draw(self, screen, camera_x=0, scale=1):
+        """ Blits the cached chunks that are visible on screen. With scale,
+        screen is 1/scale the size of the view and so are the chunks. """
+        if scale != self.render_scale:
+            self.render_scale = scale
+            self.chunk_surfaces = {}
+        chunk_size = self.CHUNK_TILES * self.tile_size
+        x = self.x - camera_x
+        first_x = max((0 - x) // chunk_size, 0)
+        last_x = min((screen.get_width() * scale - 1 - x) // chunk_size, (self.columns - 1) // self.CHUNK_TILES)
+        first_y = max((0 - self.y) // chunk_size, 0)
+        last_y = min((screen.get_height() * scale - 1 - self.y) // chunk_size, (self.rows - 1) // self.CHUNK_TILES)
+        for chunk_y in range(first_y, last_y + 1):
+            for chunk_x in range(first_x, last_x + 1):
+                key = (chunk_x, chunk_y)
+                if key not in self.chunk_surfaces:
+                    self.chunk_surfaces[key] = self.render_chunk(chunk_x, chunk_y)
+                surface = self.chunk_surfaces[key]
+                if surface is not None:
+                    screen.blit(surface, ((x + chunk_x * chunk_size) // scale, (self.y + chunk_y * chunk_size) // scale))
+
+
+class StreamedTileMap(TileMap):
+    """ A window of window_chunks chunks (CHUNK_TILES columns each) over an
+    endless world that starts at x = 0. stream() slides the window with the
+    camera, one chunk behind it: the chunks that fall out behind are dropped
+    and the ones coming into reach are copied in from chunk_rows(index),
+    which returns a (row, tiles) pair for each row of the chunk that is not
+    empty. Chunks must only depend on their index, so one reloaded after
+    walking back comes out the same (tiles destroyed in it are restored).
+    Memory and the cost of a query stay the same however far the world goes. """
+    def __init__(self, window_chunks, rows, tile_size, chunk_rows):
+        TileMap.__init__(self, window_chunks * self.CHUNK_TILES, rows, tile_size)
+        self.window_chunks = window_chunks
+        self.chunk_width = self.CHUNK_TILES * tile_size
+        self.chunk_rows = chunk_rows
+        self.first_chunk = 0
+
+    def fill(self, first_chunk=0):
+        """ Rebuilds the whole window starting at first_chunk. """
+        self.clear()
+        self.first_chunk = first_chunk
+        self.x = first_chunk * self.chunk_width
+        for index in range(first_chunk, first_chunk + self.window_chunks):
+            self.load_chunk(index)
+
+    def load_chunk(self, index):
+        chunk_x = index - self.first_chunk
+        for row, tiles in self.chunk_rows(index):
+            offset = row * self.columns + chunk_x * self.CHUNK_TILES
+            self.tiles[offset:offset + self.CHUNK_TILES] = tiles
+            self.chunk_surfaces.pop((chunk_x, row // self.CHUNK_TILES), None)
+
+    def stream(self, camera_x):
+        """ Slides the window to the camera. Returns True if it moved. """
+        first_chunk = max(camera_x // self.chunk_width - 1, 0)
+        shift = first_chunk - self.first_chunk
+        if shift == 0:
+            return False
+        if abs(shift) >= self.window_chunks:
+            self.fill(first_chunk)
+            return True
+        # move every row over by whole chunks, keeping the cached chunk surfaces
+        columns = shift * self.CHUNK_TILES
+        empty = bytes(abs(columns))
+        rows = []
+        for row in range(self.rows):
+            tiles = self.tiles[row * self.columns:(row + 1) * self.columns]
+            rows.append(tiles[columns:] + empty if shift > 0 else empty + tiles[:columns])
+        self.tiles[:] = b''.join(rows)
+        self.chunk_surfaces = dict(((chunk_x - shift, chunk_y), surface)
+                                   for (chunk_x, chunk_y), surface in self.chunk_surfaces.items()
+                                   if 0 <= chunk_x - shift < self.window_chunks)
+        self.first_chunk = first_chunk
+        self.x = first_chunk * self.chunk_width
+        if shift > 0:
+            new_chunks = range(first_chunk + self.window_chunks - shift, first_chunk + self.window_chunks)
+        else:
+            new_chunks = range(first_chunk, first_chunk - shift)
+        for index in new_chunks:
+            self.load_chunk(index)
+        return True
+
+    def set_state(self, state):
+        changed = TileMap.set_state(self, state)
+        self.first_chunk = self.x // self.chunk_width
+        return changed
+
+
+class LevelFile(object):
+    """ A level on disk, read through mmap so opening costs the same however
+    large the level is; a chunk's bytes are only touched when it streams in.
+    Layout, all little-endian:
+        header   HEADER
+        chunks   chunk_count records of CHUNK_TILES columns:
+                 rows x uint16 collision bitmasks (bit c set: column c is solid),
+                 then rows x CHUNK_TILES tile bytes
+        spawns   spawn_count SPAWN records sorted by chunk
+    The bitmasks let chunk_rows() skip empty rows without reading them. """
+    MAGIC = b'ORLV'
+    VERSION = 1
+    # magic, version, tile size, chunk columns, rows, chunk count, spawn count, player start x and y
+    HEADER = struct.Struct('<4sHHHHIIii')
+    SPAWN = struct.Struct('<BIhh') # kind, chunk, centre x within the chunk, centre y
+    SPAWN_AMMOBOX = 1
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as level_file:
+            try:
+                self.data = mmap.mmap(level_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise UserWarning("Empty level file %s." % path)
+        if len(self.data) < self.HEADER.size:
+            raise UserWarning("%s is too short to be a level file." % path)
+        (magic, version, self.tile_size, self.chunk_columns, self.rows, self.chunk_count,
+         spawn_count, start_x, start_y) = self.HEADER.unpack_from(self.data)
+        if magic != self.MAGIC:
+            raise UserWarning("%s is not a level file." % path)
+        if version != self.VERSION:
+            raise UserWarning("Unsupported level file version %s in %s." % (version, path))
+        if self.chunk_count == 0:
+            raise UserWarning("Level file %s has no chunks." % path)
+        self.player_start = (start_x, start_y)
+        self.masks = struct.Struct('<%dH' % self.rows)
+        self.record_size = self.masks.size + self.rows * self.chunk_columns
+        spawns_offset = self.HEADER.size + self.chunk_count * self.record_size
+        if len(self.data) < spawns_offset + spawn_count * self.SPAWN.size:
+            raise UserWarning("Level file %s is truncated." % path)
+        self.spawn_table = {}
+        for i in range(spawn_count):
+            kind, chunk, x, y = self.SPAWN.unpack_from(self.data, spawns_offset + i * self.SPAWN.size)
+            self.spawn_table.setdefault(chunk, []).append((kind, x, y))
+
+    def collision_masks(self, index):
+        """ The per-row collision bitmasks of a chunk. """
+        return self.masks.unpack_from(self.data, self.HEADER.size + index * self.record_size)
+
+    def chunk_rows(self, index):
+        """ (row, tiles) for every row of the chunk that has a solid tile. """
+        layout = self.HEADER.size + index * self.record_size + self.masks.size
+        columns = self.chunk_columns
+        return [(row, self.data[layout + row * columns:layout + (row + 1) * columns])
+                for row, mask in enumerate(self.collision_masks(index)) if mask]
+
+    def spawns(self, index):
+        """ (kind, x, y) of the things placed in a chunk, centred on x, y; x is relative to the chunk. """
+        return self.spawn_table.get(index, [])
+
+    def close(self):
+        self.data.close()
+
+
+class ChunkGenerator(object):
+    """ Builds level chunks from a seed: a floor with a few random gaps, the
+    odd ledge and now and then an ammo box. Used by bake_level() to write
+    level files, and as the baseline for run_level_bench(). """
+    def __init__(self, seed, rows, tile_size, columns=TileMap.CHUNK_TILES):
+        self.seed = seed
+        self.rows = rows
+        self.tile_size = tile_size
+        self.columns = columns
+
+    def chunk(self, index):
+        """ Returns the solid tiles as (column, row) and the spawns as (kind, x, y). """
+        chunk_rng = random.Random("%d:%d" % (self.seed, index))
+        columns = self.columns
+
+        # create Array with column and row of each floor tile
+        floor_row = self.rows - 1
+        level = []
+        for i in range(columns):
+            level.append((i, floor_row))
+
+        # remove a few random floor blocks (swap with the last entry so each removal is O(1))
+        for i in range(chunk_rng.randint(0, 2)):
+            index = chunk_rng.randrange(len(level))
+            level[index] = level[-1]
+            level.pop()
+
+        # sometimes a ledge; the low ones can be jumped onto
+        spawns = []
+        if chunk_rng.randint(1, 100) > 60:
+            length = chunk_rng.randint(3, 8)
+            start = chunk_rng.randrange(columns - length + 1)
+            row = floor_row - chunk_rng.randint(4, 12)
+            level.extend((column, row) for column in range(start, start + length))
+            # a quarter of the ledges hold an ammo box
+            if chunk_rng.randint(1, 100) > 75:
+                spawns.append((LevelFile.SPAWN_AMMOBOX, (start + length // 2) * self.tile_size,
+                               row * self.tile_size - AmmoBox.AMMOBOX_HEIGHT // 2))
+        return level, spawns
+
+    def chunk_rows(self, index):
+        """ Same result as LevelFile.chunk_rows() for a generated chunk. """
+        rows = {}
+        for column, row in self.chunk(index)[0]:
+            rows.setdefault(row, bytearray(self.columns))[column] = TileMap.SOLID
+        return sorted(rows.items())
+
+
+def bake_level(path, seed, chunk_count, rows=SCREEN_HEIGHT // 10, tile_size=10, player_start=(0, 0)):
+    """ Writes chunk_count generated chunks to a LevelFile. """
+    if chunk_count < 1:
+        raise UserWarning("A level needs at least one chunk, not %d." % chunk_count)
+    generator = ChunkGenerator(seed, rows, tile_size)
+    masks = struct.Struct('<%dH' % rows)
+    columns = TileMap.CHUNK_TILES
+    spawns = []
+    with open(path, 'wb') as level_file:
+        level_file.write(LevelFile.HEADER.pack(LevelFile.MAGIC, LevelFile.VERSION, tile_size, columns, rows,
+                                               chunk_count, 0, player_start[0], player_start[1]))
+        for index in range(chunk_count):
+            tiles, chunk_spawns = generator.chunk(index)
+            layout = bytearray(rows * columns)
+            row_masks = [0] * rows
+            for column, row in tiles:
+                layout[row * columns + column] = TileMap.SOLID
+                row_masks[row] |= 1 << column
+            level_file.write(masks.pack(*row_masks))
+            level_file.write(layout)
+            spawns.extend((kind, index, x, y) for kind, x, y in chunk_spawns)
+        for spawn in spawns:
+            level_file.write(LevelFile.SPAWN.pack(*spawn))
+        # the spawn count goes in the header once known
+        level_file.seek(0)
+        level_file.write(LevelFile.HEADER.pack(LevelFile.MAGIC, LevelFile.VERSION, tile_size, columns, rows,
+                                               chunk_count, len(spawns), player_start[0], player_start[1]))
 
 
 class Level():
     """ This is a generic super-class used to define a level.
     Create a child class for each level with level-specific
     info. """
-    # Lists of sprites used in all levels. Add or remove
+    # Level geometry and lists of sprites used in all levels. Add or remove
     # lists as needed for your game.
-    platform_list = None
+    tile_map = None
+    level_file = None
     enemy_list = None
-    # How far this world has been scrolled left/right
-    world_shift = 0
+    # Bumped whenever static geometry changes so cached renders can be rebuilt
+    geometry_version = 0
+    # Where the ground player starts
+    player_start = (0, 0)
 
-    def __init__(self, player):
+    def __init__(self, player, camera=None):
         """ Constructor. Pass in a handle to player. Needed for when moving
-        platforms collide with the player. """
-        self.platform_list = pygame.sprite.Group()
+        platforms collide with the player. The camera follows the player. """
         self.enemy_list = pygame.sprite.Group()
         self.player = player
+        self.camera = camera if camera is not None else Camera()
+        # Spawns of the chunks streamed in so far, waiting for the game to place them
+        self.spawns = []
+        self.spawned_to = -1
+        self.chunk_offset = 0
         # Update everything on this level
 
+    def load(self, path):
+        """ Open a baked level file and stream the tile map from it. """
+        self.level_file = LevelFile(path)
+        if self.level_file.chunk_columns != TileMap.CHUNK_TILES:
+            raise UserWarning("%s has %d columns per chunk, expected %d."
+                              % (path, self.level_file.chunk_columns, TileMap.CHUNK_TILES))
+        tile_size = self.level_file.tile_size
+        # chunks kept loaded: one behind the camera, the screen, and one ahead
+        window_chunks = SCREEN_WIDTH // (TileMap.CHUNK_TILES * tile_size) + 2
+        self.tile_map = StreamedTileMap(window_chunks, self.level_file.rows, tile_size, self.chunk_rows)
+        self.player_start = self.level_file.player_start
+        level_log.info("loaded %s: %d chunks, %d spawns", path, self.level_file.chunk_count,
+                       sum(len(spawns) for spawns in self.level_file.spawn_table.values()))
+
+    def reset(self, rng=random):
+        """ Clear the level in place so a subclass can rebuild it. """
+        self.camera.x = 0
+        self.enemy_list.empty()
+        del self.spawns[:]
+        self.spawned_to = -1
+        if self.level_file is not None:
+            # the world loops over the file's chunks, starting somewhere new each game
+            self.chunk_offset = rng.randrange(self.level_file.chunk_count)
+        if isinstance(self.tile_map, StreamedTileMap):
+            self.tile_map.fill(0)
+        elif self.tile_map is not None:
+            self.tile_map.clear()
+        self.geometry_version += 1
+
+    def chunk_rows(self, index):
+        """ The rows of world chunk index, from the level file. Queues the
+        chunk's spawns the first time it streams in. """
+        chunk = (self.chunk_offset + index) % self.level_file.chunk_count
+        if index > self.spawned_to:
+            chunk_x = index * self.tile_map.chunk_width
+            self.spawns.extend((kind, chunk_x + x, y) for kind, x, y in self.level_file.spawns(chunk))
+            self.spawned_to = index
+        return self.level_file.chunk_rows(chunk)
+
+    def get_state(self):
+        return (self.camera.x, self.chunk_offset, self.spawned_to, self.tile_map.get_state())
+
+    def set_state(self, state):
+        self.camera.x, self.chunk_offset, self.spawned_to, tiles = state
+        del self.spawns[:]
+        if self.tile_map.set_state(tiles):
+            self.geometry_version += 1
+
     def update(self):
-        """ Update everything in this level."""
-        self.platform_list.update()
+        """ Update everything in this level, scroll to the player and
+        stream in the level geometry around the camera. """
         self.enemy_list.update()
+        self.camera.follow(self.player.rect)
+        if self.tile_map.stream(self.camera.x):
+            self.geometry_version += 1
 
     def draw(self, screen):
         """ Draw everything on this level. """
+        self.draw_static(screen)
+        # Draw all the sprite lists that we have
+        screen.blits([(enemy.image, self.camera.apply(enemy.rect)) for enemy in self.enemy_list])
 
-        # Draw the background
+    def draw_static(self, screen, scale=1):
+        """ Draw the background and level geometry, at 1/scale size. """
         screen.fill(BACKGROUNDCOLOR)
-        # Draw all the sprite lists that we have
-        self.platform_list.draw(screen)
-        self.enemy_list.draw(screen)
+        self.tile_map.draw(screen, self.camera.x, scale)
 
     def shift_world(self, shift_x):
-        """ When the user moves left/right and we need to scroll everything: """
-        # Keep track of the shift amount
-        self.world_shift += shift_x
-        # Go through all the sprite lists and shift
-        for platform in self.platform_list:
-            platform.rect.x += shift_x
-        for enemy in self.enemy_list:
-            enemy.rect.x += shift_x
+        """ Scroll the view by shift_x; the world itself no longer moves. """
+        self.camera.x -= shift_x
 
-    def get_platform_list(self):
-        return self.platform_list
+    def get_tile_map(self):
+        return self.tile_map
 
 
 class Level_01(Level):
-    """ Definition for level 1.
+    """ Definition for level 1: an endless floor with a few random gaps and
+    the odd ledge, streamed in chunks from data/level_01.lvl as the player
+    runs right. Rebuild the file with --bake-level.
     """
-    BLOCKWIDTH = 10
+    LEVEL_FILE = 'level_01.lvl'
 
-    def __init__(self, player):
+    def __init__(self, player, rng=random, camera=None):
         """" Create Level 1. """
 
         # Call the parent constructor
-        Level.__init__(self, player)
+        Level.__init__(self, player, camera)
 
-        self.level_limit = -1000
+        self.load(os.path.join(LEVEL_DATAPATH, self.LEVEL_FILE))
+        self.reset(rng)
 
-        # create Array with width, height, x, and y of platform
-        level = []
-        for i in range(int(SCREEN_WIDTH/self.BLOCKWIDTH)):
-            level.append([self.BLOCKWIDTH, self.BLOCKWIDTH, self.BLOCKWIDTH*i, SCREEN_HEIGHT-self.BLOCKWIDTH])
 
-        # remove a few random floor blocks
-        for i in range(random.randint(1,10)):
-            level.remove(random.choice(level))
+# Particles
+class NullParticles(object):
+    """ Stand-in particle system that emits nothing: used without NumPy and
+    while a rollback re-simulates ticks that already showed their debris. """
+    density = 1.0
+
+    def emit(self, position, count, color, speed=None):
+        pass
+
+    def clear(self):
+        pass
+
+    def update(self):
+        pass
+
+    def draw(self, screen, scale=1):
+        return []
+
+    def count(self):
+        return 0
+
+
+class ParticleSystem(object):
+    """ Cosmetic debris, kept in fixed-size NumPy arrays and moved in one
+    vectorised step per tick. Slots are handed out by a ring allocator: emit()
+    takes the next count slots after the cursor, so when the ring is full
+    the oldest particles are overwritten and nothing is ever allocated while
+    playing. Particles are drawn as 2x2 dots straight into the screen's
+    pixels. They use their own random generator and are not part of the
+    game state, so they never change a replay or a checksum. density (0-1)
+    scales every emission, for cutting cosmetic work on slow machines.
+    Every burst is dead LIFETIME ticks after it was emitted, so the live
+    particles are the last few bursts: the slots just behind the cursor.
+    update(), draw() and count() only touch that range, not the whole ring. """
+    CAPACITY = 65536
+    LIFETIME = 45 # ticks
+    SPEED = 3.0
+    GRAVITY = 0.2
+    SIZE = 2
+
+    def __init__(self, camera=None, capacity=CAPACITY, seed=None):
+        if numpy is None:
+            raise UserWarning("The particle system needs NumPy installed.")
+        self.camera = camera if camera is not None else Camera()
+        self.capacity = capacity
+        self.x = numpy.zeros(capacity, dtype=numpy.float32)
+        self.y = numpy.zeros(capacity, dtype=numpy.float32)
+        self.change_x = numpy.zeros(capacity, dtype=numpy.float32)
+        self.change_y = numpy.zeros(capacity, dtype=numpy.float32)
+        self.life = numpy.zeros(capacity, dtype=numpy.int16)
+        self.color = numpy.zeros(capacity, dtype=numpy.uint32)
+        self.cursor = 0
+        self.tick = 0
+        # (slot count, tick it has all died by) per burst still alive, oldest first
+        self.bursts = collections.deque()
+        # slots in those bursts; the live range ends at the cursor
+        self.live = 0
+        self.density = 1.0
+        self.np_rng = numpy.random.default_rng(seed)
+        self.mapped_colors = {}
+
+    def emit(self, position, count, color, speed=SPEED):
+        """ Bursts count particles of color out of position (world coordinates). """
+        count = min(int(count * self.density), self.capacity)
+        if count <= 0:
+            return
+        slots = (self.cursor + numpy.arange(count)) % self.capacity
+        self.cursor = (self.cursor + count) % self.capacity
+        angle = self.np_rng.uniform(0, 2 * numpy.pi, count)
+        velocity = self.np_rng.uniform(0.2, 1.0, count) * speed
+        self.x[slots] = position[0]
+        self.y[slots] = position[1]
+        self.change_x[slots] = numpy.cos(angle) * velocity
+        self.change_y[slots] = numpy.sin(angle) * velocity - speed * 0.5
+        self.life[slots] = self.np_rng.integers(self.LIFETIME // 2, self.LIFETIME + 1, count)
+        self.color[slots] = self.map_color(color)
+        self.bursts.append((count, self.tick + self.LIFETIME))
+        self.live += count
+
+    def map_color(self, color):
+        """ color as a pixel value of the display format. """
+        mapped = self.mapped_colors.get(color)
+        if mapped is None:
+            display = pygame.display.get_surface()
+            mapped = display.map_rgb(color) if display is not None else 0
+            self.mapped_colors[color] = mapped
+        return mapped
+
+    def clear(self):
+        self.life[:] = 0
+        self.bursts.clear()
+        self.live = 0
+
+    def live_slices(self):
+        """ The slots of the bursts still alive, as one or two slices (two
+        when they wrap round the end of the ring). """
+        live = min(self.live, self.capacity)
+        if not live:
+            return []
+        start = (self.cursor - live) % self.capacity
+        if start < self.cursor:
+            return [slice(start, self.cursor)]
+        return [slice(start, self.capacity), slice(0, self.cursor)]
+
+    def update(self):
+        if not self.live:
+            return
+        for live in self.live_slices():
+            life = self.life[live]
+            self.change_y[live] += self.GRAVITY
+            self.x[live] += self.change_x[live]
+            self.y[live] += self.change_y[live]
+            numpy.subtract(life, 1, out=life, where=life > 0)
+        self.tick += 1
+        bursts = self.bursts
+        while bursts and bursts[0][1] <= self.tick:
+            self.live -= bursts.popleft()[0]
+
+    def count(self):
+        return sum(int(numpy.count_nonzero(self.life[live])) for live in self.live_slices())
+
+    def draw(self, screen, scale=1):
+        """ Writes the live particles on screen into its pixels. Returns the
+        rect around them in a list, like BlockSwarm.draw. With scale, screen
+        is 1/scale the size of the view. """
+        live = self.live_slices()
+        if not live:
+            return []
+        if len(live) == 1:
+            live = live[0]
+        else:
+            live = numpy.r_[live[0], live[1]]
+        width, height = screen.get_size()
+        size = max(self.SIZE // scale, 1)
+        x = (self.x[live].astype(numpy.int32) - self.camera.x) // scale
+        y = self.y[live].astype(numpy.int32) // scale
+        visible = numpy.flatnonzero((self.life[live] > 0) & (x >= 0) & (x < width - size + 1)
+                                    & (y >= 0) & (y < height - size + 1))
+        if not len(visible):
+            return []
+        x = x[visible]
+        y = y[visible]
+        color = self.color[live][visible]
+        if screen.get_bytesize() in (2, 4):
+            pixels = pygame.surfarray.pixels2d(screen)
+            for dx in range(size):
+                for dy in range(size):
+                    pixels[x + dx, y + dy] = color
+            del pixels # unlocks the screen
+        else:
+            screen.blits([(image_cache.get([size, size], screen.unmap_rgb(value)), position)
+                          for value, position in zip(color.tolist(), zip(x.tolist(), y.tolist()))], False)
+        left = int(x.min())
+        top = int(y.min())
+        return [pygame.Rect(left, top, int(x.max()) - left + size, int(y.max()) - top + size)]
+
+
+# Rendering
+class DirtyRectRenderer(object):
+    """ Draws a frame by only touching the screen areas that changed.
+    The background colour and the level's tile map are pre-rendered onto one
+    cached surface; each frame the previous sprite rects are restored from the
+    cache, the moving sprites are blitted and only those rects are pushed with
+    display.update(). When the camera moves the cache is scrolled by the same
+    amount and only the strip that came into view is repainted. It is
+    redrawn in full (into the same surface) when the level or its
+    geometry_version changes (e.g. a tile destroyed by a falling block). """
+    def __init__(self):
+        self.background = None
+        self.level = None
+        self.geometry_version = None
+        self.camera_x = None
+        self.last_rects = []
+
+    def invalidate(self):
+        """ Forces a full redraw on the next frame. """
+        self.level = None
+
+    def build_background(self, screen, level):
+        if self.background is None or self.background.get_size() != screen.get_size():
+            self.background = pygame.Surface(screen.get_size()).convert()
+        level.draw_static(self.background)
+        self.level = level
+        self.geometry_version = level.geometry_version
+        self.camera_x = level.camera.x
+
+    def scroll_background(self, level):
+        """ Moves the cached level by the camera's move since the last frame
+        and repaints the strip that came into view. """
+        background = self.background
+        width, height = background.get_size()
+        shift = self.camera_x - level.camera.x
+        self.camera_x = level.camera.x
+        background.scroll(shift, 0)
+        if shift < 0:
+            background.set_clip(pygame.Rect(width + shift, 0, -shift, height))
+        else:
+            background.set_clip(pygame.Rect(0, 0, shift, height))
+        level.draw_static(background)
+        background.set_clip(None)
+
+    def draw(self, screen, level, groups, batches=()):
+        """ Draws the sprite groups, then any batches (objects whose draw(screen)
+        returns the drawn rects, e.g. BlockSwarm), over the cached level and
+        updates the display. """
+        full_redraw = (self.background is None or level is not self.level
+                       or level.geometry_version != self.geometry_version
+                       or abs(level.camera.x - self.camera_x) >= screen.get_width())
+        scrolled = not full_redraw and level.camera.x != self.camera_x
+        if full_redraw:
+            self.build_background(screen, level)
+            screen.blit(self.background, (0, 0))
+        elif scrolled:
+            # the whole view moved, so every pixel of the screen changes
+            self.scroll_background(level)
+            screen.blit(self.background, (0, 0))
+        else:
+            # restore what the sprites covered last frame
+            for rect in self.last_rects:
+                screen.blit(self.background, rect, rect)
+
+        rects = []
+        camera = level.camera
+        for group in groups:
+            for sprite in group:
+                rects.append(screen.blit(sprite.image, camera.apply(sprite.rect)))
+        for batch in batches:
+            rects.extend(batch.draw(screen))
+
+        if full_redraw or scrolled:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.last_rects + rects)
+        self.last_rects = rects
+
+
+class BatchRenderer(object):
+    """ Collects draw commands into LAYERS and submits each layer with one
+    Surface.blits call, bottom layer first, so pickups, blocks, bullets and
+    players always stack the same way. The game's images are already in the
+    display format (image_cache, Spritesheet and TileMap convert them), so
+    at full resolution they are drawn as they are; batching is no faster
+    than a blit per sprite (see --render-bench), the layers are the point.
+    With scale above 1 the target is 1/scale the size of the view and
+    positions are divided. Sprite sheet frames are cut from the sheet at that
+    size (AssetManager.scaled_frame), so the art is not scaled up at load and
+    back down here; other images are shrunk. Either way the display format
+    copies are made once and cached by image (entity images are shared, so
+    the cache stays small). """
+    LAYERS = ('enemies', 'pickups', 'blocks', 'bullets', 'players')
+
+    def __init__(self, scale=1):
+        self.layers = dict((name, []) for name in self.LAYERS)
+        self.scaled = {}
+        self.scale = scale
+
+    def scaled_image(self, image):
+        """ image shrunk to 1/scale, in the display format. """
+        surface = self.scaled.get(image)
+        if surface is None:
+            surface = self.scaled[image] = self.shrink(image)
+        return surface
+
+    def shrink(self, image):
+        colorkey = image.get_colorkey()
+        # sprite sheet frames are cut from the sheet at the smaller size instead
+        surface = asset_manager.scaled_frame(image, self.scale)
+        if surface is None:
+            surface = pygame.transform.scale(image, (max(image.get_width() // self.scale, 1),
+                                                     max(image.get_height() // self.scale, 1)))
+        if pygame.display.get_surface() is not None:
+            surface = surface.convert_alpha() if image.get_flags() & pygame.SRCALPHA else surface.convert()
+        if colorkey is not None:
+            surface.set_colorkey(colorkey, pygame.RLEACCEL)
+        return surface
+
+    def add(self, layer, image, position):
+        if self.scale == 1:
+            self.layers[layer].append((image, position))
+        else:
+            scale = self.scale
+            self.layers[layer].append((self.scaled_image(image), (position[0] // scale, position[1] // scale)))
+
+    def add_sprites(self, layer, sprites, camera):
+        commands = self.layers[layer]
+        if self.scale == 1:
+            commands.extend([(sprite.image, camera.apply(sprite.rect)) for sprite in sprites])
+            return
+        scale = self.scale
+        scaled_image = self.scaled_image
+        for sprite in sprites:
+            commands.append((scaled_image(sprite.image), ((sprite.rect.x - camera.x) // scale, sprite.rect.y // scale)))
+
+    def extend(self, layer, commands):
+        """ Adds (image, position) commands, e.g. from BlockSwarm.commands(). """
+        if self.scale == 1:
+            self.layers[layer].extend(commands)
+            return
+        scaled_image = self.scaled_image
+        scale = self.scale
+        self.layers[layer].extend((scaled_image(image), (position[0] // scale, position[1] // scale))
+                                  for image, position in commands)
+
+    def flush(self, screen):
+        """ Draws and clears every layer. """
+        for name in self.LAYERS:
+            commands = self.layers[name]
+            if commands:
+                screen.blits(commands, False)
+                del commands[:]
+
+    def clear(self):
+        """ Forgets the scaled images, e.g. after the display mode changed. """
+        self.scaled = {}
+
+
+# Profiling
+class NullProfiler(object):
+    """ Stand-in profiler that records nothing. """
+    def lap_start(self):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def end_frame(self, game):
+        pass
+
 
-        ## DEBUG ##
-        print(level)
+class FrameProfiler(object):
+    """ Times each phase of a frame with sequential laps: lap_start() starts
+    the clock and lap(phase) charges the time since the last lap to phase.
+    end_frame() closes the frame, adds every phase to a rolling window of
+    WINDOW samples for the p50/p95/p99 figures, and (with trace) keeps a
+    per-frame row with the sprite counts for export() to CSV or JSON. """
+    WINDOW = 300
+    PHASES = ('process_events', 'sprite_update', 'level_update', 'collide_pickups', 'collide_bullets',
+              'collide_player', 'collide_plane', 'collide_tiles', 'particles', 'display_frame', 'frame')
+
+    def __init__(self, window=WINDOW, trace=False):
+        self.samples = dict((phase, collections.deque(maxlen=window)) for phase in self.PHASES)
+        self.frame_phases = {}
+        self.counts = {}
+        self.trace = [] if trace else None
+        self.start = time.perf_counter()
+        self.frame_start = self.start
+
+    def lap_start(self):
+        self.start = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.frame_phases[phase] = self.frame_phases.get(phase, 0) + (now - self.start) * 1000
+        self.start = now
+
+    def end_frame(self, game):
+        now = time.perf_counter()
+        self.frame_phases['frame'] = (now - self.frame_start) * 1000
+        self.frame_start = now
+        for phase, ms in self.frame_phases.items():
+            self.samples[phase].append(ms)
+        self.counts = game.sprite_counts()
+        if self.trace is not None:
+            row = {'frame_index': len(self.trace)}
+            row.update(self.frame_phases)
+            row.update(self.counts)
+            self.trace.append(row)
+        self.frame_phases = {}
+
+    def percentiles(self, phase):
+        """ Returns (p50, p95, p99) in ms over the rolling window, or None. """
+        data = sorted(self.samples[phase])
+        if not data:
+            return None
+        return tuple(data[min(len(data) - 1, int(q * len(data)))] for q in (.50, .95, .99))
+
+    def export(self, path):
+        """ Writes the per-frame trace as CSV, or JSON if path ends in .json. """
+        rows = self.trace or []
+        with open(path, 'w', newline='') as trace_file:
+            if path.endswith('.json'):
+                json.dump(rows, trace_file)
+            else:
+                fields = ['frame_index'] + list(self.PHASES) + sorted(self.counts)
+                writer = csv.DictWriter(trace_file, fields, restval='')
+                writer.writeheader()
+                writer.writerows(rows)
+
+
+class ProfilerOverlay(object):
+    """ Draws the profiler's percentiles, the input-to-display latency (given
+    an InputLatency) and the sprite counts in the corner of the screen. The
+    text is re-rendered every REFRESH_FRAMES frames. """
+    REFRESH_FRAMES = 15
+    TEXT_COLOR = YELLOW
+    BACKGROUND_COLOR = BLACK
+
+    def __init__(self, profiler, latency=None):
+        self.profiler = profiler
+        self.latency = latency
+        self.font = pygame.font.SysFont("monospace", 12)
+        self.surface = None
+        self.frames = 0
+
+    def render(self):
+        lines = ["%-16s %6s %6s %6s" % ('ms', 'p50', 'p95', 'p99')]
+        for phase in FrameProfiler.PHASES:
+            figures = self.profiler.percentiles(phase)
+            if figures is not None:
+                lines.append("%-16s %6.2f %6.2f %6.2f" % ((phase,) + figures))
+        figures = self.latency.percentiles() if self.latency is not None else None
+        if figures is not None:
+            lines.append("%-16s %6.2f %6.2f %6.2f" % (('input_latency',) + figures))
+        for group, count in sorted(self.profiler.counts.items()):
+            lines.append("%-16s %6d" % (group, count))
+        images = [self.font.render(line, True, self.TEXT_COLOR) for line in lines]
+        line_height = self.font.get_linesize()
+        self.surface = pygame.Surface([max(image.get_width() for image in images) + 8, line_height * len(images) + 8])
+        self.surface.fill(self.BACKGROUND_COLOR)
+        for i, image in enumerate(images):
+            self.surface.blit(image, (4, 4 + i * line_height))
 
+    def draw(self, screen):
+        """ Returns the drawn rect in a list, like BlockSwarm.draw. """
+        if self.surface is None or self.frames % self.REFRESH_FRAMES == 0:
+            self.render()
+        self.frames += 1
+        return [screen.blit(self.surface, (0, 0))]
+
+
+# Frame budget
+class FrameGovernor(object):
+    """ Keeps the frame time under budget_ms by stepping through LEVELS of
+    degradation: cosmetic particles go first, then live bullets and pickups
+    are capped and the block waves thinned out (Game.wave_scale stretches
+    the band blocks respawn in). Each frame's work time (without the sleep in
+    clock.tick) goes into a moving window; when its mean is over budget the
+    governor steps up a level, and when it has been under RECOVER of the
+    budget it steps back down. After a change it waits for a full window of
+    new frames before deciding again. Every change is logged with the
+    numbers behind it. It changes the simulation, so it is only used in
+    single player games that are not being recorded. """
+    # particles: ParticleSystem.density; bullets, pickups: live caps (None for no cap); blocks: wave scale
+    LEVELS = (
+        {'particles': 1.0, 'bullets': None, 'pickups': None, 'blocks': 1.0},
+        {'particles': 0.5, 'bullets': None, 'pickups': None, 'blocks': 1.0},
+        {'particles': 0.0, 'bullets': None, 'pickups': None, 'blocks': 1.0},
+        {'particles': 0.0, 'bullets': 12, 'pickups': 8, 'blocks': 1.0},
+        {'particles': 0.0, 'bullets': 6, 'pickups': 4, 'blocks': 0.75},
+        {'particles': 0.0, 'bullets': 3, 'pickups': 2, 'blocks': 0.5},
+    )
+    WINDOW = 30 # frames
+    RECOVER = 0.6 # fraction of the budget the frames must stay under to step back down
+
+    def __init__(self, budget_ms=1000.0 / FPS, window=WINDOW):
+        self.budget_ms = budget_ms
+        self.frames = collections.deque(maxlen=window)
+        self.level = 0
+        self.changes = 0
+
+    def settings(self):
+        return self.LEVELS[self.level]
+
+    def frame(self, game, work_ms):
+        """ Records one frame's work time and adjusts the game if needed. """
+        self.frames.append(work_ms)
+        if len(self.frames) < self.frames.maxlen:
+            return
+        mean = sum(self.frames) / len(self.frames)
+        worst = max(self.frames)
+        if mean > self.budget_ms and self.level < len(self.LEVELS) - 1:
+            self.change(game, self.level + 1, "mean frame %.2f ms (worst %.2f) over the %.2f ms budget"
+                        % (mean, worst, self.budget_ms))
+        elif worst < self.budget_ms * self.RECOVER and self.level > 0:
+            self.change(game, self.level - 1, "worst frame %.2f ms under %.2f ms"
+                        % (worst, self.budget_ms * self.RECOVER))
+
+    def change(self, game, level, reason):
+        previous = self.level
+        self.level = level
+        self.changes += 1
+        self.frames.clear()
+        self.apply(game)
+        governor_log.info("%s: level %d -> %d %s", reason, previous, level, self.settings())
+
+    def apply(self, game):
+        """ Puts the current level's settings into effect. """
+        settings = self.settings()
+        game.particles.density = settings['particles']
+        game.bullet_cap = settings['bullets']
+        game.pickup_cap = settings['pickups']
+        game.wave_scale = settings['blocks']
+        for block in game.block_list:
+            block.wave_scale = game.wave_scale
+        if game.swarm:
+            game.swarm.wave_scale = game.wave_scale
+
+
+# Snapshots
+# Binary layout of Game.snapshot(), little-endian; bump SNAPSHOT_VERSION on any change
+SNAPSHOT_MAGIC = b'ORSS'
+DELTA_MAGIC = b'ORSD'
+SNAPSHOT_VERSION = 3
+SNAPSHOT_COMPRESSED = 1 # header flag: the body is zlib-compressed
+SNAPSHOT_HEADER = struct.Struct('<4sHH') # magic, version, flags
+DELTA_HEADER = struct.Struct('<4sHI') # magic, version, length of the target snapshot
+RNG_STATE = struct.Struct('<625I?d') # Mersenne Twister key and position, gauss_next
+GAME_STATE = struct.Struct('<i?H') # score, game_over, sprite count
+SPRITE_STATES = (
+    # (kind, layout, position of change_x in the layout or None). The kind
+    # code is the index; each record starts with the kind code and a byte
+    # marking which speeds were floats (bit 0 change_x, bit 1 change_y), as
+    # ints and floats checksum differently. Rects are stored as their topleft
+    (PlanePlayer, struct.Struct('<iiiii'), None), # x, y, ammo, offset_x, offset_y
+    (GroundPlayer, struct.Struct('<iiddBBBBBBB'), 2), # x, y, change_x, change_y, animation state, direction,
+                                                      # images list, animation index/delay, image list and index
+    (Block, struct.Struct('<iiBdd?'), 3), # x, y, payload, change_x, change_y, gravity
+    (Bullet, struct.Struct('<ii'), None), # x, y
+    (AmmoBox, struct.Struct('<iidd'), 2), # x, y, change_x, change_y
+)
+SPRITE_KINDS = dict((kind, code) for code, (kind, layout, speed) in enumerate(SPRITE_STATES))
+LEVEL_STATE = struct.Struct('<iIiiiI') # camera x, chunk offset, spawned to, tile map x, y, tile count; then the tiles
+SWARM_STATE = struct.Struct('<I16s16s?I') # block count (0: no swarm), PCG64 state, inc, has_uint32, uinteger
+# swarm arrays in BlockSwarm.get_state() order, stored back to back after SWARM_STATE
+SWARM_DTYPES = ('<i8', '<i8', '<f8', '?', 'i1', '?', '<i8')
+
+
+def pack_snapshot(snapshot, compress=False):
+    """ Encodes a Game.snapshot() as bytes. The fixed-size sections come
+    first and the sprites last, so consecutive frames line up for
+    delta_encode(). """
+    rng_version, key, gauss_next = snapshot['rng']
+    parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, SNAPSHOT_COMPRESSED if compress else 0)]
+    body = [RNG_STATE.pack(*(key + (gauss_next is not None, gauss_next or 0.0)))]
+
+    camera_x, chunk_offset, spawned_to, (tiles, x, y) = snapshot['level']
+    body.append(LEVEL_STATE.pack(camera_x, chunk_offset, spawned_to, x, y, len(tiles)))
+    body.append(tiles)
+
+    swarm = snapshot['swarm']
+    if swarm is None:
+        body.append(SWARM_STATE.pack(0, bytes(16), bytes(16), False, 0))
+    else:
+        generator = swarm[-1]
+        body.append(SWARM_STATE.pack(len(swarm[0]), generator['state']['state'].to_bytes(16, 'little'),
+                                     generator['state']['inc'].to_bytes(16, 'little'),
+                                     bool(generator['has_uint32']), generator['uinteger']))
+        for array, dtype in zip(swarm, SWARM_DTYPES):
+            body.append(array.astype(dtype, copy=False).tobytes())
+
+    sprites = snapshot['sprites']
+    body.append(GAME_STATE.pack(snapshot['score'], snapshot['game_over'], len(sprites)))
+    for kind, state in sprites:
+        code = SPRITE_KINDS[kind]
+        layout, speed = SPRITE_STATES[code][1:]
+        floats = 0
+        if speed is not None:
+            # the state tuple holds the rect as one item, the layout as two
+            floats = sum(1 << bit for bit, value in enumerate(state[speed - 1:speed + 1]) if isinstance(value, float))
+        body.append(bytes((code, floats)))
+        if kind is PlanePlayer:
+            rect, ammo, offset_x, offset_y = state
+            body.append(layout.pack(rect[0], rect[1], ammo, offset_x, offset_y))
+        elif kind is GroundPlayer:
+            (rect, change_x, change_y, animation, direction, images_list,
+             animation_index, animation_delay, (image_list, image_index)) = state
+            body.append(layout.pack(rect[0], rect[1], change_x, change_y, animation.value if animation else 0,
+                                    direction.value if direction else 0,
+                                    GroundPlayer.IMAGE_LISTS.index(images_list) + 1 if images_list else 0,
+                                    animation_index, animation_delay, GroundPlayer.IMAGE_LISTS.index(image_list),
+                                    image_index))
+        elif kind is Block:
+            rect, payload, change_x, change_y, gravity = state
+            body.append(layout.pack(rect[0], rect[1], Block.PAYLOADS.index(payload) + 1 if payload else 0,
+                                    change_x, change_y, gravity))
+        elif kind is Bullet:
+            body.append(layout.pack(state[0], state[1]))
+        else:
+            rect, change_x, change_y = state
+            body.append(layout.pack(rect[0], rect[1], change_x, change_y))
+
+    body = b''.join(body)
+    parts.append(zlib.compress(body, 1) if compress else body)
+    return b''.join(parts)
+
+def unpack_snapshot(data):
+    """ Decodes pack_snapshot() bytes back into a snapshot for Game.restore(). """
+    magic, version, flags = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise UserWarning("Not a game snapshot.")
+    if version != SNAPSHOT_VERSION:
+        raise UserWarning("Unsupported snapshot version %s." % version)
+    body = data[SNAPSHOT_HEADER.size:]
+    if flags & SNAPSHOT_COMPRESSED:
+        body = zlib.decompress(body)
+
+    rng = RNG_STATE.unpack_from(body)
+    snapshot = {'rng': (3, rng[:625], rng[626] if rng[625] else None)}
+    offset = RNG_STATE.size
+
+    camera_x, chunk_offset, spawned_to, x, y, count = LEVEL_STATE.unpack_from(body, offset)
+    offset += LEVEL_STATE.size
+    snapshot['level'] = (camera_x, chunk_offset, spawned_to, (bytes(body[offset:offset + count]), x, y))
+    offset += count
+
+    count, state, inc, has_uint32, uinteger = SWARM_STATE.unpack_from(body, offset)
+    offset += SWARM_STATE.size
+    snapshot['swarm'] = None
+    if count:
+        if numpy is None:
+            raise UserWarning("The block swarm needs NumPy installed.")
+        arrays = []
+        for dtype in SWARM_DTYPES:
+            array = numpy.frombuffer(body, dtype, count, offset)
+            arrays.append(array)
+            offset += array.nbytes
+        generator = {'bit_generator': 'PCG64', 'has_uint32': int(has_uint32), 'uinteger': uinteger,
+                     'state': {'state': int.from_bytes(state, 'little'), 'inc': int.from_bytes(inc, 'little')}}
+        snapshot['swarm'] = tuple(arrays) + (generator,)
+
+    snapshot['score'], snapshot['game_over'], count = GAME_STATE.unpack_from(body, offset)
+    offset += GAME_STATE.size
+    sprites = []
+    payloads = [None] + Block.PAYLOADS
+    for i in range(count):
+        kind, layout, speed = SPRITE_STATES[body[offset]]
+        floats = body[offset + 1]
+        values = layout.unpack_from(body, offset + 2)
+        offset += 2 + layout.size
+        rect = values[:2]
+        if speed is not None:
+            values = (values[:speed] + tuple(value if floats & (1 << bit) else int(value)
+                                             for bit, value in enumerate(values[speed:speed + 2])) + values[speed + 2:])
+        if kind is PlanePlayer:
+            state = (rect,) + values[2:]
+        elif kind is GroundPlayer:
+            (change_x, change_y, animation, direction, images_list,
+             animation_index, animation_delay, image_list, image_index) = values[2:]
+            state = (rect, change_x, change_y,
+                     GroundPlayer.ANIM_STATES(animation) if animation else None,
+                     GroundPlayer.ANIM_DIRECTIONS(direction) if direction else None,
+                     GroundPlayer.IMAGE_LISTS[images_list - 1] if images_list else None,
+                     animation_index, animation_delay, (GroundPlayer.IMAGE_LISTS[image_list], image_index))
+        elif kind is Block:
+            state = (rect, payloads[values[2]]) + values[3:]
+        elif kind is Bullet:
+            state = rect
+        else:
+            state = (rect,) + values[2:]
+        sprites.append((kind, state))
+    snapshot['sprites'] = sprites
+    return snapshot
+
+def delta_encode(base, data):
+    """ Encodes snapshot bytes as the zlib-compressed XOR with an earlier
+    snapshot; between consecutive frames almost every byte XORs to zero. """
+    length = len(data)
+    size = max(length, len(base))
+    xor = int.from_bytes(base, 'little') ^ int.from_bytes(data, 'little')
+    return DELTA_HEADER.pack(DELTA_MAGIC, SNAPSHOT_VERSION, length) + zlib.compress(xor.to_bytes(size, 'little'), 1)
+
+def delta_decode(base, delta):
+    """ Rebuilds the snapshot bytes from the base and a delta_encode() result. """
+    magic, version, length = DELTA_HEADER.unpack_from(delta)
+    if magic != DELTA_MAGIC or version != SNAPSHOT_VERSION:
+        raise UserWarning("Unsupported snapshot delta.")
+    xor = int.from_bytes(zlib.decompress(delta[DELTA_HEADER.size:]), 'little')
+    return (int.from_bytes(base, 'little') ^ xor).to_bytes(max(length, len(base)), 'little')[:length]
+
+
+# Networking
+class SessionInput(object):
+    """ Input source for a networked Game: RollbackSession sets the merged
+    input of both players before each simulated tick. """
+    def __init__(self):
+        self.pos = (0, 0)
+        self.events = []
+
+    def set_frame(self, pos, events):
+        self.pos = pos
+        self.events = events
+
+    def poll(self):
+        return [pygame.event.Event(event_type, attributes) for event_type, attributes in self.events]
+
+    def get_pos(self):
+        return self.pos
+
+
+class UdpTransport(object):
+    """ Sends and receives JSON packets over a non-blocking UDP socket. The
+    first peer heard from becomes the remote when none is given. Outgoing
+    packets can be delayed by latency_ms (+/- jitter_ms) and dropped with
+    probability loss to try the netcode on localhost; pass a clock to run on
+    virtual time. """
+    MAX_PACKET = 65507
+
+    def __init__(self, port=0, remote=None, latency_ms=0, jitter_ms=0, loss=0.0, clock=time.perf_counter, rng=None):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('', port))
+        self.socket.setblocking(False)
+        self.port = self.socket.getsockname()[1]
+        self.remote = remote
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.loss = loss
+        self.clock = clock
+        self.rng = rng if rng is not None else random.Random()
+        self.queue = []
+        self.sequence = 0
+        self.sent = 0
+        self.lost = 0
+
+    def send(self, packet):
+        if self.remote is None:
+            return
+        self.sent += 1
+        if self.loss and self.rng.random() < self.loss:
+            self.lost += 1
+            return
+        delay = max(self.latency + self.rng.uniform(-self.jitter, self.jitter), 0)
+        self.sequence += 1
+        heapq.heappush(self.queue, (self.clock() + delay, self.sequence, json.dumps(packet, separators=(',', ':')).encode()))
+        self.flush()
+
+    def flush(self):
+        """ Puts the delayed packets that are due on the wire. """
+        now = self.clock()
+        while self.queue and self.queue[0][0] <= now:
+            data = heapq.heappop(self.queue)[2]
+            try:
+                self.socket.sendto(data, self.remote)
+            except OSError as message:
+                net_log.warning("send failed: %s", message)
+
+    def receive(self):
+        """ Returns the packets that have arrived. """
+        self.flush()
+        packets = []
+        while True:
+            try:
+                data, address = self.socket.recvfrom(self.MAX_PACKET)
+            except OSError:
+                return packets
+            if self.remote is None:
+                self.remote = address
+            try:
+                packets.append(json.loads(data.decode()))
+            except ValueError:
+                net_log.warning("bad packet from %s", address)
+
+    def close(self):
+        self.socket.close()
+
+
+def handshake(transport, role, seed=None, swarm_size=0, timeout=30):
+    """ The host (plane) waits for a hello and answers with the game seed and
+    swarm size; the joining ground player sends hellos until it gets them.
+    Returns (seed, swarm_size). """
+    if seed is None:
+        seed = random.randrange(2**31)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if role == 'ground':
+            transport.send({'type': 'hello'})
+        for packet in transport.receive():
+            if role == 'plane' and packet.get('type') == 'hello':
+                transport.send({'type': 'welcome', 'seed': seed, 'swarm_size': swarm_size})
+                return seed, swarm_size
+            if role == 'ground' and packet.get('type') == 'welcome':
+                return packet['seed'], packet['swarm_size']
+        if pygame.display.get_init():
+            pygame.event.pump()
+        time.sleep(0.05)
+    raise UserWarning("No answer from the other player.")
+
+
+class RollbackSession(object):
+    """ GGPO-style rollback for two players on separate machines. Each tick
+    the local player's input is sent to the peer and the game is simulated
+    at once, predicting that the remote player did nothing new (same mouse
+    position, no events -- held keys live on in the player's speed). A
+    snapshot is taken before every tick; when the real remote input turns
+    out to differ from the prediction, the game is restored to that tick and
+    re-simulated up to the present. A peer stalls instead of running more
+    than MAX_ROLLBACK ticks past the other's confirmed input.
+    Packets carry every local input the peer has not acknowledged, so lost
+    packets need no retransmit timer, and the checksum of the newest state
+    both sides agree on, to detect desyncs. """
+    ROLES = ('plane', 'ground')
+    EMPTY_INPUT = {'plane': [[0, 0], []], 'ground': [None, []]}
+    MAX_INPUTS_PER_PACKET = 32
+    CHECKSUM_HISTORY = 3600 # confirmed checksums kept, in ticks
+
+    def __init__(self, game, role, transport, max_rollback=MAX_ROLLBACK):
+        self.game = game
+        self.role = role
+        self.remote_role = self.ROLES[1 - self.ROLES.index(role)]
+        self.transport = transport
+        self.max_rollback = max_rollback
+        self.welcome = None
+        # next tick to simulate
+        self.tick = 0
+        self.local_inputs = {}
+        self.remote_inputs = {}
+        # remote input used for each unconfirmed tick, predicted or real
+        self.used_inputs = {}
+        # (snapshot, checksum) taken before each unconfirmed tick
+        self.snapshots = {}
+        # every remote input before this tick has arrived
+        self.remote_confirmed = 0
+        # every local input before this tick has reached the peer
+        self.remote_acked = 0
+        self.rollback_to = None
+        self.confirmed_checksums = {}
+        self.last_confirmed = None
+        self.remote_checksums = {}
+        self.rollbacks = 0
+        self.resimulated = 0
+        self.max_depth = 0
+        self.stalls = 0
+        self.desyncs = 0
+
+    def sample(self, source):
+        """ Polls source and splits its events into this player's game input
+        and the events that stay local (QUIT, F3, F12...). """
+        events = []
+        local = []
+        for event in source.poll():
+            if action_map.player(event) == self.role:
+                events.append([event.type, dict((name, getattr(event, name)) for name in InputRecorder.EVENT_ATTRIBUTES
+                                                if name != 'pos' and hasattr(event, name))])
+            else:
+                local.append(event)
+        pos = list(source.get_pos()) if self.role == 'plane' else None
+        return [pos, events], local
+
+    def predict(self):
+        """ The remote player keeps the mouse where it was and sends no events. """
+        last = self.remote_inputs.get(self.remote_confirmed - 1)
+        if last is None:
+            return self.EMPTY_INPUT[self.remote_role]
+        return [last[0], []]
+
+    def receive(self):
+        for packet in self.transport.receive():
+            if packet.get('type') == 'hello' and self.welcome is not None:
+                # our welcome was lost
+                self.transport.send(self.welcome)
+            if packet.get('type') != 'input':
+                continue
+            self.remote_acked = max(self.remote_acked, packet['ack'])
+            for tick, remote_input in enumerate(packet['inputs'], packet['start']):
+                if tick < self.remote_confirmed or tick in self.remote_inputs:
+                    continue
+                self.remote_inputs[tick] = remote_input
+                if tick < self.tick and self.used_inputs[tick] != remote_input:
+                    if self.rollback_to is None or tick < self.rollback_to:
+                        self.rollback_to = tick
+            if packet['check'] is not None:
+                tick, checksum = packet['check']
+                self.remote_checksums[tick] = checksum
+                self.compare_checksum(tick)
+        while self.remote_confirmed in self.remote_inputs:
+            self.remote_confirmed += 1
+
+    def send(self):
+        start = self.remote_acked
+        end = min(self.tick, start + self.MAX_INPUTS_PER_PACKET)
+        self.transport.send({'type': 'input', 'start': start, 'ack': self.remote_confirmed, 'check': self.last_confirmed,
+                             'inputs': [self.local_inputs[tick] for tick in range(start, end)]})
+
+    def simulate(self, tick):
+        """ Runs one tick with the local input and the real or predicted remote input. """
+        game = self.game
+        self.snapshots[tick] = (game.snapshot(), game.checksum())
+        remote_input = self.remote_inputs.get(tick)
+        if remote_input is None:
+            remote_input = self.predict()
+        self.used_inputs[tick] = remote_input
+        inputs = {self.role: self.local_inputs[tick], self.remote_role: remote_input}
+        plane, ground = inputs['plane'], inputs['ground']
+        game.input.set_frame(tuple(plane[0]), [(event_type, attributes) for event_type, attributes in plane[1] + ground[1]])
+        game.process_events()
+        game.run_logic()
 
-        # add platforms per specs in level array
-        for platform in level:
-            block = Platform(platform[0], platform[1])
-            block.rect.x = platform[2]
-            block.rect.y = platform[3]
-            block.player = self.player # set to ground player
-            self.platform_list.add(block)
+    def rollback(self):
+        """ Restores the first mispredicted tick and re-simulates up to the present, muted. """
+        target = self.rollback_to
+        self.rollback_to = None
+        depth = self.tick - target
+        self.rollbacks += 1
+        self.resimulated += depth
+        self.max_depth = max(self.max_depth, depth)
+        net_log.debug("rollback %d ticks to tick %d", depth, target)
+        self.game.restore(self.snapshots[target][0])
+        AudioLocator.provide(None)
+        particles, self.game.particles = self.game.particles, NullParticles()
+        for tick in range(target, self.tick):
+            self.simulate(tick)
+        self.game.particles = particles
+        AudioLocator.provide(self.game.audio)
+
+    def confirm(self):
+        """ Drops the snapshots no rollback can reach any more; the state before
+        each of them is final, so its checksum is kept for desync checks. """
+        for tick in sorted(tick for tick in self.snapshots if tick < self.remote_confirmed):
+            self.confirmed_checksums[tick] = self.snapshots.pop(tick)[1]
+            self.last_confirmed = (tick, self.confirmed_checksums[tick])
+            del self.used_inputs[tick]
+            self.compare_checksum(tick)
+        # local inputs are kept until the peer has them and no rollback can need them
+        for tick in [tick for tick in self.local_inputs if tick < min(self.remote_acked, self.remote_confirmed)]:
+            del self.local_inputs[tick]
+        # the newest confirmed remote input is the base of predictions
+        for tick in [tick for tick in self.remote_inputs if tick < self.remote_confirmed - 1]:
+            del self.remote_inputs[tick]
+        while len(self.confirmed_checksums) > self.CHECKSUM_HISTORY:
+            del self.confirmed_checksums[next(iter(self.confirmed_checksums))]
+        for tick in [tick for tick in self.remote_checksums if tick < self.tick - self.CHECKSUM_HISTORY]:
+            del self.remote_checksums[tick]
+
+    def compare_checksum(self, tick):
+        local = self.confirmed_checksums.get(tick)
+        remote = self.remote_checksums.get(tick)
+        if local is not None and remote is not None:
+            del self.remote_checksums[tick]
+            if local != remote:
+                self.desyncs += 1
+                net_log.error("desync at tick %d", tick)
+
+    def sync(self):
+        """ Handles the packets that arrived, rolling back if a prediction was wrong. """
+        self.receive()
+        if self.rollback_to is not None:
+            self.rollback()
+
+    def step(self, source):
+        """ One network tick: handle arrived input (rolling back if needed),
+        then sample source and simulate the next tick. Returns the local-only
+        events, or None while stalled waiting for the peer. """
+        self.sync()
+        if self.tick - self.remote_confirmed >= self.max_rollback:
+            self.stalls += 1
+            self.send()
+            return None
+        self.local_inputs[self.tick], local = self.sample(source)
+        self.send()
+        self.simulate(self.tick)
+        self.tick += 1
+        self.confirm()
+        return local
+
+    def stats(self):
+        return {'tick': self.tick, 'confirmed': self.remote_confirmed, 'rollbacks': self.rollbacks,
+                'resimulated': self.resimulated, 'max_rollback': self.max_depth, 'stalls': self.stalls,
+                'desyncs': self.desyncs, 'sent': self.transport.sent, 'lost': self.transport.lost}
 
 
 class Game(object):
     """ This class represents an instance of the game. If we need to
-    reset the game we'd just need to create a new instance of this
-    class. """
+    reset the game we call reset(), which keeps the loaded assets, sprite
+    groups and players and only reinitialises the game state. """
     # --- Class attributes.
     # In this case, all the data we need
     # to run our game.
@@ -673,171 +3277,1135 @@ class Game(object):
     # Other data
     game_over = False
     score = 0
+    # debris particles per shot block and per destroyed tile
+    SHOT_PARTICLES = 40
+    TILE_PARTICLES = 12
+    # live bullet and pickup limits set by a FrameGovernor (None for no limit)
+    bullet_cap = None
+    pickup_cap = None
+    # blocks respawn in a band 1/wave_scale times as tall; set per game by Game.reset and a FrameGovernor
+    wave_scale = 1.0
+    # FrameGovernor adjusting the above, set by main()
+    governor = None
     # --- Class methods
     # Set up the game
 
-    def __init__(self):
-        self.score = 0
-        self.game_over = False
+    def __init__(self, rng=None, input_source=None, audio=None, renderer=None, swarm_size=0, profiler=None,
+                 render_scale=1, particles=None):
+        """ rng, input_source, audio and particles can be injected for
+        headless runs; they default to the global random module, the
+        mouse/keyboard, StandardAudio and a ParticleSystem (pass
+        NullParticles when nobody watches the frames). Pass a DirtyRectRenderer to only redraw changed areas,
+        a swarm_size to replace the block sprites with a BlockSwarm and a
+        FrameProfiler to time each phase of the frame (F3 shows it). With a
+        render_scale of 2 or 4, display_frame draws to a screen that size
+        smaller than the view. """
+        if renderer is not None and render_scale != 1:
+            raise UserWarning("The dirty rect renderer only draws at full resolution.")
+        self.renderer = renderer
+        self.render_scale = render_scale
+        self.batch_renderer = BatchRenderer(render_scale)
+        self.profiler = profiler if profiler is not None else NullProfiler()
+        self.overlay = None
+        self.input_latency = InputLatency()
+        self.swarm_size = swarm_size
+        self.swarm = None
+        # callables run with the game after every run_logic (recording, replay checks)
+        self.tick_hooks = []
+
+        self.rng = rng if rng is not None else random
+        self.input = input_source if input_source is not None else LiveInput()
 
         # Load Sounds
-        self.load_sounds()
+        self.load_sounds(audio)
 
         # Create sprite lists
-        self.pickups_list = pygame.sprite.Group()
-        self.bullet_list = pygame.sprite.Group()
-        self.block_list = pygame.sprite.Group()
+        self.pickups_list = SpatialHashGroup()
+        self.bullet_list = SpatialHashGroup()
+        self.block_list = SpatialHashGroup()
         self.all_sprites_list = pygame.sprite.Group()
-        # Create the block sprites
-        for i in range(5):
-            block = Block()
-            block.rect.x = random.randrange(SCREEN_WIDTH)
-            block.rect.y = random.randrange(-300, SCREEN_HEIGHT)
-            self.block_list.add(block)
-            self.all_sprites_list.add(block)
+
+        # view onto the scrolling world, shared by the level, plane and blocks
+        self.camera = Camera()
+
+        # debris from shot blocks and crashed tiles (cosmetic only)
+        if particles is None:
+            particles = ParticleSystem(self.camera) if numpy is not None else NullParticles()
+        self.particles = particles
+
         # Create the plane player
-        self.player = PlanePlayer()
-        self.all_sprites_list.add(self.player)
+        self.player = PlanePlayer(self.input, self.camera)
 
         # Create the ground player
         self.player2 = GroundPlayer()
-        self.all_sprites_list.add(self.player2)
 
-        # Create the levels
+        # the levels are created by the first reset
         self.level_list = []
-        self.level_list.append(Level_01(self.player2))
+
+        # restart timing: reset() duration and restart-to-first-frame time
+        self.restart_started = None
+        self.last_reset_ms = None
+        self.last_restart_ms = None
+
+        self.reset()
+
+    def reset(self):
+        """ Start a new game in place: pooled sprites go back to their pools
+        and score, ammo, blocks and level tiles are reinitialised. """
+        start = time.perf_counter()
+        self.score = 0
+        self.game_over = False
+        self.forget_positions()
+        self.release_sprites()
+        self.particles.clear()
+        self.wave_scale = self.governor.settings()['blocks'] if self.governor else 1.0
+
+        # Create the block sprites, or the swarm in their place
+        if self.swarm_size:
+            if self.swarm is None:
+                self.swarm = BlockSwarm(self.swarm_size, self.rng, self.camera)
+            else:
+                self.swarm.reset(self.rng)
+            self.swarm.wave_scale = self.wave_scale
+        for i in range(0 if self.swarm else 5):
+            block = block_pool.acquire(self.rng, self.camera, self.wave_scale)
+            block.rect.x = self.rng.randrange(SCREEN_WIDTH)
+            block.rect.y = self.rng.randrange(-300, SCREEN_HEIGHT)
+            self.block_list.add(block)
+            self.all_sprites_list.add(block)
+
+        self.player.reset()
+        self.all_sprites_list.add(self.player)
+        self.player2.reset()
+        self.all_sprites_list.add(self.player2)
+
+        # Create the levels, or rebuild them in place
+        if not self.level_list:
+            self.level_list.append(Level_01(self.player2, self.rng, self.camera))
+        else:
+            for level in self.level_list:
+                level.reset(self.rng)
 
         # set current level
         self.current_level_num = 0
         self.current_level = self.level_list[self.current_level_num]
         # associate level with player
         self.player2.level = self.current_level
-
-    def load_sounds(self):
-        global audioSystem # TODO replace direct call to audioSystem with audioLocator.provide()?
-        audioSystem = StandardAudio()
-        #audioSystem = NullAudio() # mute sound
+        self.player2.rect.topleft = self.current_level.player_start
+        self.spawn_level_items()
+        self.last_reset_ms = (time.perf_counter() - start) * 1000
+
+    def spawn_level_items(self):
+        """ Places the pickups of the chunks the level streamed in since the last call. """
+        level = self.current_level
+        for kind, x, y in level.spawns:
+            if kind == LevelFile.SPAWN_AMMOBOX and self.pickup_room():
+                p = ammobox_pool.acquire((x, y), level.get_tile_map())
+                self.pickups_list.add(p)
+                self.all_sprites_list.add(p)
+        del level.spawns[:]
+
+    def pickup_room(self):
+        """ False while the live pickups are at pickup_cap. """
+        if self.pickup_cap is None or len(self.pickups_list) < self.pickup_cap:
+            return True
+        governor_log.debug("pickup skipped: %d live, cap %d", len(self.pickups_list), self.pickup_cap)
+        return False
+
+    def load_sounds(self, audio=None):
+        if audio is None:
+            audio = StandardAudio()
+            #audio = NullAudio() # mute sound
+        self.audio = audio
+        AudioLocator.provide(audio)
+
+    def save_positions(self):
+        """ Remember where every sprite and the camera are before a simulation
+        step so frames drawn between steps can be interpolated. """
+        for sprite in self.all_sprites_list:
+            sprite.previous_pos = sprite.rect.topleft
+        self.previous_camera_x = self.camera.x
+
+    def forget_positions(self):
+        """ Stops every sprite and the camera being interpolated until the
+        next save_positions. """
+        for sprite in self.all_sprites_list:
+            sprite.previous_pos = None
+        self.previous_camera_x = None
+
+    def interpolate_positions(self, alpha):
+        """ Moves each sprite rect, and the camera, alpha of the way from its
+        saved position to its current one, so the level, the sprites and the
+        camera offsets they are drawn with all come from the same moment.
+        Returns (sprite, topleft) pairs to restore after drawing; display_frame
+        puts the camera back. """
+        moved = []
+        if self.previous_camera_x is not None:
+            dx = self.camera.x - self.previous_camera_x
+            if abs(dx) <= INTERPOLATION_MAX_DISTANCE:
+                self.camera.x = self.previous_camera_x + int(dx * alpha)
+        for sprite in self.all_sprites_list:
+            previous = getattr(sprite, 'previous_pos', None)
+            if previous is None:
+                continue
+            current = sprite.rect.topleft
+            dx = current[0] - previous[0]
+            dy = current[1] - previous[1]
+            if (dx or dy) and abs(dx) <= INTERPOLATION_MAX_DISTANCE and abs(dy) <= INTERPOLATION_MAX_DISTANCE:
+                moved.append((sprite, current))
+                sprite.rect.topleft = (previous[0] + int(dx * alpha), previous[1] + int(dy * alpha))
+        return moved
+
+    def release_sprites(self):
+        """ Kill every sprite so pooled ones go back to their pools. """
+        for sprite in self.all_sprites_list.sprites():
+            sprite.kill()
+
+    def snapshot(self):
+        """ Captures the simulation state for restore(): the RNG, score, every
+        sprite in update order, the level tiles and the swarm. """
+        return {'rng': self.rng.getstate(), 'score': self.score, 'game_over': self.game_over,
+                'sprites': [(type(sprite), sprite.get_state()) for sprite in self.all_sprites_list],
+                'level': self.current_level.get_state(),
+                'swarm': self.swarm.get_state() if self.swarm else None}
+
+    def restore(self, snapshot):
+        """ Puts the game back to a snapshot(). Pooled sprites are released and
+        re-acquired in their original order so groups update and collide in the
+        same order as before. """
+        self.forget_positions()
+        self.release_sprites()
+        tile_map = self.current_level.get_tile_map()
+        for kind, state in snapshot['sprites']:
+            groups = []
+            if kind is PlanePlayer:
+                sprite = self.player
+            elif kind is GroundPlayer:
+                sprite = self.player2
+            elif kind is Block:
+                sprite = block_pool.acquire(self.rng, self.camera, self.wave_scale)
+                groups = [self.block_list]
+            elif kind is Bullet:
+                sprite = bullet_pool.acquire((0, 0))
+                groups = [self.bullet_list]
+            else:
+                sprite = ammobox_pool.acquire((0, 0), tile_map)
+                groups = [self.pickups_list]
+            sprite.set_state(state)
+            for group in groups + [self.all_sprites_list]:
+                group.add(sprite)
+        self.current_level.set_state(snapshot['level'])
+        if self.swarm:
+            self.swarm.set_state(snapshot['swarm'])
+        self.score = snapshot['score']
+        self.game_over = snapshot['game_over']
+        # last, as acquiring blocks draws from the RNG
+        self.rng.setstate(snapshot['rng'])
+
+    def save_state(self, compress=False):
+        """ The snapshot as compact versioned bytes (see pack_snapshot). """
+        return pack_snapshot(self.snapshot(), compress)
+
+    def load_state(self, data):
+        self.restore(unpack_snapshot(data))
 
     def process_events(self):
         """ Process all of the events. Return a "True" if we need
         to close the window. """
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                return True
-
-            # checking for mouse up before mouse down to prevent initial shot on game restart
-            if event.type == pygame.MOUSEBUTTONUP:
-                self.player.fire([self.bullet_list, self.all_sprites_list])
-                if self.game_over:
-                    self.__init__()
-                    return False
-
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                pass
-
-
-
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_LEFT:
-                    self.player2.go_left()
-                if event.key == pygame.K_RIGHT:
-                    self.player2.go_right()
-                if event.key == pygame.K_UP:
-                    self.player2.jump()
-
-            if event.type == pygame.KEYUP:
-                if event.key == pygame.K_LEFT and self.player2.change_x < 0:
-                    self.player2.stop()
-                if event.key == pygame.K_RIGHT and self.player2.change_x > 0:
-                    self.player2.stop()
+        self.profiler.lap_start()
+        done = self.handle_events()
+        self.profiler.lap('process_events')
+        return done
+
+    def handle_events(self):
+        for event in self.input.poll():
+            actions = action_map.actions(event)
+            if actions:
+                self.input_latency.handled(event)
+            for action, pressed in actions:
+                if action == 'quit':
+                    return True
+
+                # fire is on release (mouse up) to prevent an initial shot on game restart
+                if action == 'fire':
+                    if self.bullet_cap is not None and len(self.bullet_list) >= self.bullet_cap:
+                        governor_log.debug("shot refused: %d bullets live, cap %d", len(self.bullet_list), self.bullet_cap)
+                    else:
+                        self.player.fire([self.bullet_list, self.all_sprites_list])
+                    if self.game_over:
+                        self.restart_started = time.perf_counter()
+                        self.reset()
+                        game_log.info("reset took %.3f ms", self.last_reset_ms)
+                        return False
+
+                if pressed:
+                    if action == 'left':
+                        self.player2.go_left()
+                    if action == 'right':
+                        self.player2.go_right()
+                    if action == 'jump':
+                        self.player2.jump()
+                    if action == 'dump_log':
+                        dump_log()
+                    if action == 'toggle_overlay':
+                        self.toggle_overlay()
+                else:
+                    if action == 'left' and self.player2.change_x < 0:
+                        self.player2.stop()
+                    if action == 'right' and self.player2.change_x > 0:
+                        self.player2.stop()
+
+    def toggle_overlay(self):
+        """ Shows or hides the profiler overlay, starting a profiler if needed. """
+        if self.overlay is not None:
+            self.overlay = None
+            return
+        if not isinstance(self.profiler, FrameProfiler):
+            self.profiler = FrameProfiler()
+        self.overlay = ProfilerOverlay(self.profiler, self.input_latency)
+
+    def sprite_counts(self):
+        """ Number of sprites in each group, for the profiler. """
+        return {'blocks': len(self.block_list), 'bullets': len(self.bullet_list), 'pickups': len(self.pickups_list),
+                'all_sprites': len(self.all_sprites_list), 'swarm': self.swarm.count() if self.swarm else 0,
+                'particle_count': self.particles.count(), 'governor_level': self.governor.level if self.governor else 0}
 
     def run_logic(self):
         """
         This method is run each time through the frame. It
         updates positions and checks for collisions.
         """
+        profiler = self.profiler
+        profiler.lap_start()
         if not self.game_over:
             # Move all the sprites
             self.all_sprites_list.update()
+            # re-bucket the moving sprites in the broad-phase grids
+            self.pickups_list.refresh()
+            self.bullet_list.refresh()
+            self.block_list.refresh()
+            if self.swarm:
+                self.swarm.update()
+            profiler.lap('sprite_update')
 
             ### DOES THIS WORK? ####
             self.current_level.update()
+            self.spawn_level_items()
+            profiler.lap('level_update')
 
             # check if a player hit a pickup
-            pickups_hit_list = pygame.sprite.spritecollide(self.player2, self.pickups_list, True)
+            pickups_hit_list = spritecollide(self.player2, self.pickups_list, True)
             for pickup in pickups_hit_list:
                 pickup.activate(self.player) # add effect to airplayer -- currently poorly named player
-                print("pickup gathered!")
+                pickup_log.info("pickup gathered!")
+            profiler.lap('collide_pickups')
 
             # check if a bullet hit a falling block (kill block and bullet)
-            blocks_hit_list = pygame.sprite.groupcollide(self.block_list, self.bullet_list, True, True)
+            blocks_hit_list = groupcollide(self.block_list, self.bullet_list, True, True)
             for block in blocks_hit_list:
-                block.drop([self.pickups_list, self.all_sprites_list], self.current_level.get_platform_list())
+                if self.pickup_room():
+                    block.drop([self.pickups_list, self.all_sprites_list], self.current_level.get_tile_map())
+                self.particles.emit(block.rect.center, self.SHOT_PARTICLES, Block.PAYLOAD_COLORS[block.payload])
+            if self.swarm:
+                for index in self.swarm.shoot(self.bullet_list):
+                    if self.pickup_room():
+                        self.swarm.drop(index, [self.pickups_list, self.all_sprites_list],
+                                        self.current_level.get_tile_map())
+                    self.particles.emit(self.swarm.rect(index).center, self.SHOT_PARTICLES,
+                                        BlockSwarm.PAYLOAD_COLORS[self.swarm.payload[index]])
+            profiler.lap('collide_bullets')
 
             # Check if falling block hits a player (game over)
-            blocks_hit_list = pygame.sprite.spritecollide(self.player2, self.block_list, False)
+            # (rects first, then the player's pixels so see-through corners don't count)
+            blocks_hit_list = spritecollide(self.player2, self.block_list, False, collide_solid)
             for block in blocks_hit_list:
-                print("Ouch!")
+                game_log.info("Ouch!")
                 self.game_over = True;
+            if self.swarm and self.swarm.hits(self.player2.rect, lambda rect: collide_mask_rect(self.player2, rect)):
+                game_log.info("Ouch!")
+                self.game_over = True
+            profiler.lap('collide_player')
 
             # See if the player block has collided with anything.
-            blocks_hit_list = pygame.sprite.spritecollide(self.player, self.block_list, True)
+            blocks_hit_list = spritecollide(self.player, self.block_list, True)
             # Check the list of collisions.
             for block in blocks_hit_list:
                 self.score += 1
-                print(self.score)
+                game_log.info("score: %d", self.score)
                 # You can do something with "block" here.
-
-            # See if block hits platform
-            blocks_hit_list = pygame.sprite.groupcollide(self.current_level.get_platform_list(), self.block_list, True, False)
+            if self.swarm:
+                collected = self.swarm.collect(self.player.rect)
+                if collected:
+                    self.score += collected
+                    game_log.info("score: %d", self.score)
+            profiler.lap('collide_plane')
+
+            # See if block hits the level geometry
+            tiles_destroyed = 0
+            for block in self.block_list:
+                destroyed = block.crash(self.current_level.get_tile_map())
+                if destroyed:
+                    self.particles.emit(block.rect.midbottom, destroyed * self.TILE_PARTICLES, TileMap.TILE_COLOR)
+                    tiles_destroyed += destroyed
+            if self.swarm:
+                crashed = []
+                tiles_destroyed += self.swarm.crash(self.current_level.get_tile_map(), crashed)
+                for rect, destroyed in crashed:
+                    self.particles.emit(rect.midbottom, destroyed * self.TILE_PARTICLES, TileMap.TILE_COLOR)
+            if tiles_destroyed:
+                self.current_level.geometry_version += 1
+            profiler.lap('collide_tiles')
+
+            self.particles.update()
+            profiler.lap('particles')
             # debug
             #for block in blocks_hit_list:
                 # print("crash!")
 
-        if len(self.block_list) == 0:
+        if len(self.block_list) == 0 and (self.swarm is None or self.swarm.count() == 0):
             self.game_over = True
 
-    def display_frame(self, screen):
-        """ Display everything to the screen for the game. """
-        screen.fill(WHITE)
+        for hook in self.tick_hooks:
+            hook(self)
+
+    def checksum(self):
+        """ CRC32 of the simulation state, used to verify replays tick by tick. """
+        state = [self.score, self.game_over, self.camera.x, self.player.ammo, self.player.offset_y, tuple(self.player.rect),
+                 tuple(self.player2.rect), self.player2.change_x, self.player2.change_y]
+        for group in (self.block_list, self.bullet_list, self.pickups_list):
+            state.append([(tuple(sprite.rect), getattr(sprite, 'payload', None), getattr(sprite, 'change_y', 0))
+                          for sprite in group])
+        crc = zlib.crc32(repr(state).encode())
+        crc = zlib.crc32(self.current_level.tile_map.tiles, crc)
+        if self.swarm:
+            for array in (self.swarm.x, self.swarm.y, self.swarm.change_y, self.swarm.payload, self.swarm.alive):
+                crc = zlib.crc32(array.tobytes(), crc)
+        return crc
+
+    def display_frame(self, screen, alpha=None):
+        """ Display everything to the screen for the game. With alpha (0-1),
+        sprites are drawn that far between their last two simulated positions. """
+        self.profiler.lap_start()
+        overlays = [self.overlay] if self.overlay is not None else []
+        moved = []
+        camera_x = self.camera.x
+        if alpha is not None and not self.game_over:
+            moved = self.interpolate_positions(alpha)
+        if self.swarm:
+            self.swarm.alpha = alpha
         if self.game_over:
-            font = pygame.font.SysFont("serif", 25)
+            screen.fill(WHITE)
+            font = pygame.font.SysFont("serif", 25 // self.render_scale + 1)
             text = font.render("Game Over, click to restart", True, BLACK)
-            center_x = (SCREEN_WIDTH // 2) - (text.get_width() // 2)
-            center_y = (SCREEN_HEIGHT // 2) - (text.get_height() // 2)
+            center_x = (screen.get_width() // 2) - (text.get_width() // 2)
+            center_y = (screen.get_height() // 2) - (text.get_height() // 2)
             screen.blit(text, [center_x, center_y])
             pygame.display.flip()
-        if not self.game_over:
-            self.current_level.draw(screen)
-            self.all_sprites_list.draw(screen)
+            if self.renderer is not None:
+                self.renderer.invalidate()
+        elif self.renderer is not None:
+            self.renderer.draw(screen, self.current_level, [self.current_level.enemy_list, self.all_sprites_list],
+                               ([self.swarm] if self.swarm else []) + [self.particles] + overlays)
+        else:
+            self.current_level.draw_static(screen, self.render_scale)
+            batch = self.batch_renderer
+            batch.add_sprites('enemies', self.current_level.enemy_list, self.camera)
+            batch.add_sprites('pickups', self.pickups_list, self.camera)
+            batch.add_sprites('blocks', self.block_list, self.camera)
+            if self.swarm:
+                batch.extend('blocks', self.swarm.commands((screen.get_width() * self.render_scale,
+                                                            screen.get_height() * self.render_scale)))
+            batch.add_sprites('bullets', self.bullet_list, self.camera)
+            batch.add_sprites('players', [player for player in (self.player2, self.player) if player.alive()],
+                              self.camera)
+            batch.flush(screen)
+            self.particles.draw(screen, self.render_scale)
+            for overlay in overlays:
+                overlay.draw(screen)
             pygame.display.flip()
-
-def main():
-    """ Main program function. """
-    pygame.mixer.pre_init(22050, -16, 2, 1024)
+        self.input_latency.frame_shown()
+        for sprite, topleft in moved:
+            sprite.rect.topleft = topleft
+        self.camera.x = camera_x
+        if self.restart_started is not None and not self.game_over:
+            self.last_restart_ms = (time.perf_counter() - self.restart_started) * 1000
+            self.restart_started = None
+            game_log.info("restart to first frame took %.3f ms", self.last_restart_ms)
+        self.profiler.lap('display_frame')
+        self.profiler.end_frame(self)
+
+def run_fixed_step(game, screen, display_fps=FPS):
+    """ Game loop with a fixed simulation step decoupled from rendering.
+    Real time accumulates and is spent in SIM_RATE steps; at most
+    MAX_FRAMESKIP steps run before a frame is drawn, and any backlog beyond
+    that is dropped so a slow machine slows down instead of spiralling.
+    Frames are drawn interpolated between the last two steps. display_fps
+    caps the render rate (0 for uncapped). """
+    step = 1.0 / SIM_RATE
+    clock = pygame.time.Clock()
+    accumulator = 0.0
+    previous = time.perf_counter()
+    done = False
+    while not done:
+        now = time.perf_counter()
+        accumulator += min(now - previous, MAX_FRAME_TIME)
+        previous = now
+
+        steps = 0
+        while accumulator >= step and steps < MAX_FRAMESKIP and not done:
+            # Process events (keystrokes, mouse clicks, etc)
+            done = game.process_events()
+            # Update object positions, check for collisions
+            game.save_positions()
+            game.run_logic()
+            accumulator -= step
+            steps += 1
+        if steps == MAX_FRAMESKIP:
+            # drop the backlog we could not catch up on
+            accumulator = min(accumulator, step)
+
+        # Draw the current frame between the last two simulation steps
+        game.display_frame(screen, accumulator / step)
+        if game.governor is not None:
+            game.governor.frame(game, (time.perf_counter() - now) * 1000)
+        clock.tick(display_fps)
+
+def main(dirty_rects=False, swarm_size=0, fixed_step=False, display_fps=FPS, seed=None, record_path=None, profiler=None,
+         governor=None, render_scale=1):
+    """ Main program function. With a render_scale of 2 or 4 the game draws
+    at that fraction of the resolution and SDL scales the window up. """
+    pygame.mixer.pre_init(MIXER_FREQUENCY, -16, 2, MIXER_BUFFER)
     # Initialize Pygame and set up the window
     pygame.init()
-    size = [SCREEN_WIDTH, SCREEN_HEIGHT]
-    screen = pygame.display.set_mode(size)
+    size = [SCREEN_WIDTH // render_scale, SCREEN_HEIGHT // render_scale]
+    screen = pygame.display.set_mode(size, pygame.SCALED if render_scale != 1 else 0)
     pygame.display.set_caption(SCREEN_TITLE)
     pygame.mouse.set_visible(False)
     # Create our objects and set the data
     done = False
     clock = pygame.time.Clock()
     # Create an instance of the Game class
-    game = Game()
+    rng = None
+    input_source = LiveInput(render_scale)
+    if record_path is not None:
+        # a recording needs a known seed to be replayed
+        if seed is None:
+            seed = random.randrange(2**31)
+        input_source = InputRecorder(input_source, seed, swarm_size)
+    if seed is not None:
+        rng = random.Random(seed)
+    game = Game(rng, input_source, renderer=DirtyRectRenderer() if dirty_rects else None, swarm_size=swarm_size,
+                profiler=profiler, render_scale=render_scale)
+    if record_path is not None:
+        game.tick_hooks.append(input_source.end_tick)
+        if governor is not None:
+            # its changes depend on the machine's speed, so the replay would diverge
+            governor_log.warning("frame governor disabled while recording")
+            governor = None
+    game.governor = governor
+    if fixed_step:
+        run_fixed_step(game, screen, display_fps)
+        done = True
     # Main game loop
     while not done:
+        frame_start = time.perf_counter()
         # Process events (keystrokes, mouse clicks, etc)
         done = game.process_events()
         # Update object positions, check for collisions
         game.run_logic()
         # Draw the current frame
         game.display_frame(screen)
+        if game.governor is not None:
+            game.governor.frame(game, (time.perf_counter() - frame_start) * 1000)
         # Pause for the next frame
         clock.tick(FPS)
+    audio_log.info("audio stats: %s", AudioLocator.get().stats())
+    figures = game.input_latency.percentiles()
+    if figures is not None:
+        input_log.info("input to display latency: p50 %.1f  p95 %.1f  p99 %.1f ms", *figures)
+    if record_path is not None:
+        input_source.save(record_path)
+        game_log.info("recorded %d ticks with seed %d to %s", len(input_source.frames), seed, record_path)
     # Close window and exit
     pygame.quit()
+def init_headless():
+    """ Initialise pygame with dummy video and audio drivers. """
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    pygame.init()
+    # a display mode is still needed for Surface.convert() on the spritesheet
+    pygame.display.set_mode([SCREEN_WIDTH, SCREEN_HEIGHT])
+
+def run_headless(ticks, seed=None, frames=None, swarm_size=0, profiler=None):
+    """ Steps the simulation as fast as possible with no window, no sound,
+    no clock.tick and no display.flip. Returns (game, ticks run, ticks_per_second);
+    fewer than ticks run if the game quits first. """
+    init_headless()
+    rng = random.Random(seed)
+    if frames is None:
+        frames = make_demo_script(random.Random(seed), ticks)
+    game = Game(rng, ScriptedInput(frames), NullAudio(), swarm_size=swarm_size, profiler=profiler,
+                particles=NullParticles())
+    start = time.perf_counter()
+    ran = 0
+    while ran < ticks:
+        if game.process_events():
+            break
+        game.run_logic()
+        game.profiler.end_frame(game)
+        ran += 1
+    elapsed = time.perf_counter() - start
+    pygame.quit()
+    return game, ran, ran / elapsed if elapsed > 0 else float('inf')
+
+def play_bot_game(seed, max_ticks=BATCH_MAX_TICKS, swarm_size=0):
+    """ Plays one headless game with bots until game over or max_ticks.
+    Expects init_headless() to have been called in this process. Returns
+    the game's outcome and numbers as a dict. """
+    bots = BotInput()
+    game = Game(random.Random(seed), bots, NullAudio(), swarm_size=swarm_size, particles=NullParticles())
+    bots.game = game
+    try:
+        start = time.perf_counter()
+        ticks = 0
+        while ticks < max_ticks and not game.game_over:
+            game.process_events()
+            game.run_logic()
+            ticks += 1
+        elapsed = time.perf_counter() - start
+        if not game.game_over:
+            outcome = 'timeout'
+        elif len(game.block_list) == 0 and (game.swarm is None or game.swarm.count() == 0):
+            outcome = 'cleared'
+        else:
+            outcome = 'hit'
+        return {'seed': seed, 'ticks': ticks, 'outcome': outcome, 'score': game.score, 'fired': bots.fired,
+                'dry': bots.dry, 'gained': bots.gained, 'ammo_left': game.player.ammo,
+                'tps': ticks / elapsed if elapsed > 0 else float('inf')}
+    finally:
+        # a worker plays many games; hand the pooled sprites back between them
+        game.release_sprites()
+
+def run_batch(games, workers=None, seed=0, max_ticks=BATCH_MAX_TICKS, swarm_size=0):
+    """ Plays games bot games across a pool of worker processes, game i
+    with seed + i. Returns (results, wall_seconds). """
+    workers = workers or os.cpu_count() or 1
+    seeds = list(range(seed, seed + games))
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_headless) as pool:
+        results = list(pool.map(play_bot_game, seeds, [max_ticks] * games, [swarm_size] * games,
+                                chunksize=max(1, games // (workers * 4))))
+    return results, time.perf_counter() - start
+
+def batch_report(results, wall, workers):
+    """ Summary lines for a run_batch() result. """
+    def spread(values):
+        values = sorted(values)
+        return "mean %.1f  median %s  min %s  max %s" % (sum(values) / len(values), values[len(values) // 2],
+                                                         values[0], values[-1])
+    outcomes = collections.Counter(result['outcome'] for result in results)
+    ticks = sum(result['ticks'] for result in results)
+    fired = sum(result['fired'] for result in results)
+    return [
+        "games %d on %d workers in %.2f s: %.1f games/s, %.0f ticks/s overall, %.0f ticks/s per game" %
+        (len(results), workers, wall, len(results) / wall, ticks / wall,
+         sum(result['tps'] for result in results) / len(results)),
+        "outcomes: %s" % ', '.join("%s %d" % item for item in sorted(outcomes.items())),
+        "survival ticks: %s" % spread([result['ticks'] for result in results]),
+        "score: %s" % spread([result['score'] for result in results]),
+        "ammo: %d fired, %d picked up, %d dry clicks, %.1f left per game, %.2f picked up per shot" %
+        (fired, sum(result['gained'] for result in results), sum(result['dry'] for result in results),
+         sum(result['ammo_left'] for result in results) / len(results),
+         sum(result['gained'] for result in results) / fired if fired else 0),
+    ]
+
+def run_replay(path, verify=True):
+    """ Replays a recording headless and uncapped through the normal
+    process_events/run_logic path, checking the state checksum every tick.
+    Returns (ticks, ticks_per_second, first_mismatched_tick or None). """
+    recording = load_recording(path)
+    if not recording['frames']:
+        raise UserWarning("Nothing to replay: %s has no recorded ticks." % path)
+    init_headless()
+    game = Game(random.Random(recording['seed']), ScriptedInput(recording['frames']), NullAudio(),
+                swarm_size=recording['swarm_size'], particles=NullParticles())
+    checksums = recording['checksums']
+    mismatch = []
+    if verify:
+        def check(game):
+            tick = game.input.tick
+            if not mismatch and game.checksum() != checksums[tick]:
+                mismatch.append(tick)
+        game.tick_hooks.append(check)
+    ticks = len(recording['frames'])
+    start = time.perf_counter()
+    for tick in range(ticks):
+        game.process_events()
+        game.run_logic()
+        if mismatch:
+            break
+    elapsed = time.perf_counter() - start
+    pygame.quit()
+    return tick + 1, (tick + 1) / elapsed if elapsed > 0 else float('inf'), mismatch[0] if mismatch else None
+
+def run_snapshot_bench(ticks, seed=None, swarm_size=0):
+    """ Saves the state after every headless tick and times save_state(),
+    load_state() and delta encoding against the previous tick. Every state
+    is decoded and compared, and the last one is loaded into a fresh game
+    to check the checksum survives. Returns a dict of mean microseconds and
+    mean byte sizes. """
+    init_headless()
+    rng = random.Random(seed)
+    frames = make_demo_script(random.Random(seed), ticks)
+    game = Game(rng, ScriptedInput(frames), NullAudio(), swarm_size=swarm_size, particles=NullParticles())
+    totals = collections.Counter()
+    previous = None
+    for tick in range(ticks):
+        game.process_events()
+        game.run_logic()
+        start = time.perf_counter()
+        data = game.save_state()
+        saved = time.perf_counter()
+        snapshot = unpack_snapshot(data)
+        unpacked = time.perf_counter()
+        totals['save_us'] += (saved - start) * 1e6
+        totals['unpack_us'] += (unpacked - saved) * 1e6
+        totals['full_bytes'] += len(data)
+        if previous is not None:
+            delta = delta_encode(previous, data)
+            encoded = time.perf_counter()
+            if delta_decode(previous, delta) != data:
+                raise UserWarning("Snapshot delta did not round-trip at tick %d." % tick)
+            totals['delta_us'] += (encoded - unpacked) * 1e6
+            totals['delta_bytes'] += len(delta)
+        if pack_snapshot(snapshot) != data:
+            raise UserWarning("Snapshot did not round-trip at tick %d." % tick)
+        previous = data
+    totals['compressed_bytes'] = len(game.save_state(compress=True)) * ticks
+    checksum = game.checksum()
+    start = time.perf_counter()
+    game.load_state(data)
+    totals['load_us'] = (time.perf_counter() - start) * 1e6 * ticks
+    if game.checksum() != checksum:
+        raise UserWarning("Loading the snapshot changed the game state.")
+    pygame.quit()
+    results = dict((name, value / ticks) for name, value in totals.items())
+    results['delta_us'] = totals['delta_us'] / max(ticks - 1, 1)
+    results['delta_bytes'] = totals['delta_bytes'] / max(ticks - 1, 1)
+    return results
+
+def resident_kb():
+    """ (private, file-backed) resident memory of this process in KiB, or
+    None where /proc is missing. Mapped level pages are file-backed: the OS
+    can drop them at any time and reread them from the file. """
+    try:
+        with open('/proc/self/statm') as statm:
+            resident, shared = [int(field) for field in statm.read().split()[1:3]]
+        page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+        return ((resident - shared) * page_kb, shared * page_kb)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def run_level_bench(chunks, seed=None):
+    """ Compares building the level by generating chunks as they stream in
+    (how Level_01 used to do it) with streaming them from a baked level file.
+    Times opening the level and filling the first window, then streaming
+    every chunk, and the resident memory each way adds. Returns a dict
+    {'generated': ..., 'baked': ...} of timings in ms and memory in KiB. """
+    seed = random.Random(seed).randrange(2**32)
+    rows = SCREEN_HEIGHT // 10
+    window = SCREEN_WIDTH // (TileMap.CHUNK_TILES * 10) + 2
+    path = os.path.join(tempfile.gettempdir(), 'oreStorm-bench-%d.lvl' % os.getpid())
+    start = time.perf_counter()
+    bake_level(path, seed, chunks, rows)
+    bake_ms = (time.perf_counter() - start) * 1000
+    results = {}
+    try:
+        for name in ('generated', 'baked'):
+            memory = resident_kb()
+            start = time.perf_counter()
+            if name == 'generated':
+                source = ChunkGenerator(seed, rows, 10)
+            else:
+                source = LevelFile(path)
+            tile_map = StreamedTileMap(window, rows, 10, source.chunk_rows)
+            tile_map.fill(0)
+            loaded = time.perf_counter()
+            for chunk in range(1, chunks - window + 1):
+                tile_map.stream((chunk + 1) * tile_map.chunk_width)
+            streamed = time.perf_counter()
+            after = resident_kb()
+            results[name] = {'load_ms': (loaded - start) * 1000,
+                             'chunk_us': (streamed - loaded) * 1e6 / max(chunks - window, 1),
+                             'resident_kb': None if memory is None else (after[0] - memory[0], after[1] - memory[1]),
+                             'checksum': zlib.crc32(bytes(tile_map.tiles))}
+            if name == 'baked':
+                source.close()
+    finally:
+        os.remove(path)
+    if results['generated']['checksum'] != results['baked']['checksum']:
+        raise UserWarning("The baked level does not match the generated one.")
+    results['baked']['bake_ms'] = bake_ms
+    results['baked']['file_kb'] = (LevelFile.HEADER.size + chunks * (rows * 2 + rows * TileMap.CHUNK_TILES)) / 1024.0
+    return results
+
+def run_render_bench(counts=(10, 1000, 10000), frames=60, seed=None):
+    """ Times drawing count sprites per frame with the same images the game
+    uses (the converted, RLE colour keyed GroundPlayer frames and the shared
+    block surfaces from image_cache) three ways: one Group.draw blit per
+    sprite, the single screen.blits over all sprites that display_frame did
+    before BatchRenderer, and BatchRenderer. Half the sprites are blocks,
+    half are ground player frames. All three must leave the same pixels.
+    Returns {count: (group_ms, blits_ms, batched_ms)} per frame. """
+    init_headless()
+    screen = pygame.display.get_surface()
+    rng = random.Random(seed)
+    player = GroundPlayer()
+    player_frames = player.images_right + player.images_left
+    block_images = [image_cache.get([Block.BLOCK_WIDTH, Block.BLOCK_HEIGHT], color)
+                    for color in Block.PAYLOAD_COLORS.values()]
+    camera = Camera()
+    results = {}
+    for count in counts:
+        group = pygame.sprite.Group()
+        for i in range(count):
+            sprite = pygame.sprite.Sprite()
+            if i % 2:
+                sprite.image = player_frames[i % len(player_frames)]
+            else:
+                sprite.image = rng.choice(block_images)
+            sprite.rect = sprite.image.get_rect(topleft=(rng.randrange(SCREEN_WIDTH), rng.randrange(SCREEN_HEIGHT)))
+            group.add(sprite)
+        timings = []
+        pixels = []
+        batch = BatchRenderer()
+        for path in ('group', 'blits', 'batched'):
+            screen.fill(WHITE)
+            start = time.perf_counter()
+            for frame in range(frames):
+                if path == 'group':
+                    group.draw(screen)
+                elif path == 'blits':
+                    screen.blits([(sprite.image, camera.apply(sprite.rect)) for sprite in group])
+                else:
+                    batch.add_sprites('blocks', group, camera)
+                    batch.flush(screen)
+            timings.append((time.perf_counter() - start) * 1000 / frames)
+            pixels.append(pygame.image.tobytes(screen, 'RGB'))
+        if pixels[0] != pixels[1] or pixels[0] != pixels[2]:
+            raise UserWarning("The render paths drew %d sprites differently." % count)
+        results[count] = tuple(timings)
+    pygame.quit()
+    return results
+
+def run_particle_bench(count, frames=120, seed=None):
+    """ Keeps about count particles alive (bursts from random points every
+    tick replace the ones dying) and times update() and draw() per frame.
+    Returns (mean live particles, update ms, draw ms). """
+    init_headless()
+    screen = pygame.display.get_surface()
+    particles = ParticleSystem(capacity=max(count * 2, ParticleSystem.CAPACITY), seed=seed)
+    rng = random.Random(seed)
+    colors = (TileMap.TILE_COLOR,) + BlockSwarm.PAYLOAD_COLORS[1:]
+    # particles live 3/4 of LIFETIME on average
+    burst = max(count * 4 // (ParticleSystem.LIFETIME * 3), 1)
+    live = update_ms = draw_ms = 0
+    for frame in range(frames):
+        for i in range(4):
+            particles.emit((rng.randrange(SCREEN_WIDTH), rng.randrange(SCREEN_HEIGHT)), burst // 4 + 1,
+                           rng.choice(colors))
+        start = time.perf_counter()
+        particles.update()
+        updated = time.perf_counter()
+        screen.fill(BACKGROUNDCOLOR)
+        filled = time.perf_counter()
+        particles.draw(screen)
+        drawn = time.perf_counter()
+        update_ms += (updated - start) * 1000
+        draw_ms += (drawn - filled) * 1000
+        live += particles.count()
+    pygame.quit()
+    return live / frames, update_ms / frames, draw_ms / frames
+
+def run_render_scale_bench(frames=300, seed=None, swarm_size=0, scales=(1, 2, 4)):
+    """ Plays the demo script and draws every frame into an off-screen
+    target at each render scale, timing the level fill and tile blits
+    (draw_static), the full display_frame, and a software upscale of the
+    target to the full view (an upper bound for what pygame.SCALED costs;
+    on a real display that is done by the GPU). Returns
+    {scale: (static_ms, frame_ms, upscale_ms)} per frame. """
+    init_headless()
+    results = {}
+    for scale in scales:
+        game = Game(random.Random(seed), ScriptedInput(make_demo_script(random.Random(seed), frames)), NullAudio(),
+                    swarm_size=swarm_size, render_scale=scale)
+        target = pygame.Surface([SCREEN_WIDTH // scale, SCREEN_HEIGHT // scale]).convert()
+        view = pygame.Surface([SCREEN_WIDTH, SCREEN_HEIGHT]).convert()
+        static_ms = frame_ms = upscale_ms = 0
+        try:
+            for frame in range(frames):
+                game.process_events()
+                game.run_logic()
+                start = time.perf_counter()
+                game.current_level.draw_static(target, scale)
+                drawn = time.perf_counter()
+                game.display_frame(target)
+                shown = time.perf_counter()
+                if scale != 1:
+                    pygame.transform.scale(target, (SCREEN_WIDTH, SCREEN_HEIGHT), view)
+                scaled = time.perf_counter()
+                static_ms += (drawn - start) * 1000
+                frame_ms += (shown - drawn) * 1000
+                upscale_ms += (scaled - shown) * 1000
+        finally:
+            game.release_sprites()
+        results[scale] = (static_ms / frames, frame_ms / frames, upscale_ms / frames)
+    pygame.quit()
+    return results
+
+def run_netplay(role, transport, seed=None, swarm_size=0, dirty_rects=False):
+    """ Plays one side of a networked game: the host flies the plane with the
+    mouse, the joining player runs with the arrow keys. """
+    pygame.mixer.pre_init(MIXER_FREQUENCY, -16, 2, MIXER_BUFFER)
+    pygame.init()
+    screen = pygame.display.set_mode([SCREEN_WIDTH, SCREEN_HEIGHT])
+    pygame.display.set_caption("%s (%s)" % (SCREEN_TITLE, role))
+    pygame.mouse.set_visible(role != 'plane')
+    net_log.info("waiting for the other player")
+    seed, swarm_size = handshake(transport, role, seed, swarm_size)
+    game = Game(random.Random(seed), SessionInput(), renderer=DirtyRectRenderer() if dirty_rects else None,
+                swarm_size=swarm_size)
+    session = RollbackSession(game, role, transport)
+    if role == 'plane':
+        session.welcome = {'type': 'welcome', 'seed': seed, 'swarm_size': swarm_size}
+    source = LiveInput()
+    clock = pygame.time.Clock()
+    done = False
+    while not done:
+        events = session.step(source)
+        if events is None:
+            # stalled: leave the events queued for the next tick
+            pygame.event.pump()
+        for event in events or []:
+            for action, pressed in action_map.actions(event):
+                if action == 'quit':
+                    done = True
+                if action == 'dump_log' and pressed:
+                    dump_log()
+                if action == 'toggle_overlay' and pressed:
+                    game.toggle_overlay()
+        game.display_frame(screen)
+        clock.tick(FPS)
+    net_log.info("session stats: %s", session.stats())
+    transport.close()
+    pygame.quit()
+
+def run_net_test(ticks, seed=None, latency_ms=50, jitter_ms=10, loss=0.05, swarm_size=0):
+    """ Runs both peers of a networked game in one process over localhost
+    UDP on a virtual 60 Hz clock, with simulated latency, jitter and loss,
+    each side feeding its half of the headless demo script. Every confirmed
+    checksum of both peers is checked against a single-machine run of the
+    same script. Returns (stats per role, number of mismatched ticks). """
+    init_headless()
+    if seed is None:
+        seed = random.randrange(2**31)
+    frames = make_demo_script(random.Random(seed), ticks)
+    game = Game(random.Random(seed), ScriptedInput(frames), NullAudio(), swarm_size=swarm_size,
+                particles=NullParticles())
+    expected = []
+    try:
+        for tick in range(ticks):
+            expected.append(game.checksum())
+            game.process_events()
+            game.run_logic()
+    finally:
+        game.release_sprites()
+
+    now = [0.0]
+    clock = lambda: now[0]
+    host = UdpTransport(0, None, latency_ms, jitter_ms, loss, clock, random.Random(seed + 1))
+    join = UdpTransport(0, ('127.0.0.1', host.port), latency_ms, jitter_ms, loss, clock, random.Random(seed + 2))
+    peers = []
+    for role, transport in (('plane', host), ('ground', join)):
+        game = Game(random.Random(seed), SessionInput(), NullAudio(), swarm_size=swarm_size,
+                    particles=NullParticles())
+        peers.append((RollbackSession(game, role, transport), ScriptedInput(frames)))
+    try:
+        # a peer may never confirm the last ticks, so give up after a while
+        for step in range(ticks * 4):
+            if all(session.remote_confirmed >= ticks for session, source in peers):
+                break
+            now[0] += 1.0 / SIM_RATE
+            for session, source in peers:
+                if session.tick < ticks:
+                    session.step(source)
+                else:
+                    session.sync()
+                    session.send()
+        mismatches = 0
+        for session, source in peers:
+            session.confirm()
+            for tick, checksum in session.confirmed_checksums.items():
+                if checksum != expected[tick]:
+                    mismatches += 1
+    finally:
+        for session, source in peers:
+            session.game.release_sprites()
+            session.transport.close()
+    pygame.quit()
+    return dict((session.role, session.stats()) for session, source in peers), mismatches
+
 # Call the main function, start up the game
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description=SCREEN_TITLE)
+    parser.add_argument('--headless', action='store_true', help="run the simulation without a window or sound")
+    parser.add_argument('--ticks', type=int, default=10000, help="number of headless ticks to run")
+    parser.add_argument('--seed', type=int, default=None, help="seed for the game's random number generator")
+    parser.add_argument('--atlas', action='store_true', help="load sprite frames from a pre-baked atlas, baking it if needed")
+    parser.add_argument('--dirty-rects', action='store_true', help="only redraw the screen areas that changed")
+    parser.add_argument('--swarm', type=int, default=0, metavar='N', help="replace the falling blocks with a NumPy swarm of N blocks")
+    parser.add_argument('--fixed-step', action='store_true', help="run the simulation at a fixed rate decoupled from rendering")
+    parser.add_argument('--display-fps', type=int, default=FPS, help="render rate cap for --fixed-step (0 for uncapped)")
+    parser.add_argument('--record', default=None, metavar='PATH', help="record the seed and per-tick input to PATH")
+    parser.add_argument('--replay', default=None, metavar='PATH', help="replay a recording headless at full speed and verify it")
+    parser.add_argument('--profile', action='store_true', help="time each frame phase (F3 toggles the overlay in-game)")
+    parser.add_argument('--profile-trace', default=None, metavar='PATH', help="export per-frame timings to PATH (.csv or .json)")
+    parser.add_argument('--host', type=int, nargs='?', const=NET_PORT, default=None, metavar='PORT',
+                        help="host a network game on PORT and fly the plane (default %d)" % NET_PORT)
+    parser.add_argument('--join', default=None, metavar='HOST[:PORT]', help="join a network game as the ground player")
+    parser.add_argument('--net-latency', type=float, default=0, metavar='MS', help="simulated one-way latency added to sent packets")
+    parser.add_argument('--net-jitter', type=float, default=0, metavar='MS', help="simulated random latency variation")
+    parser.add_argument('--net-loss', type=float, default=0, metavar='P', help="simulated packet loss probability (0-1)")
+    parser.add_argument('--net-test', type=int, default=None, metavar='TICKS',
+                        help="run both network peers over localhost and check they stay in sync")
+    parser.add_argument('--snapshot-bench', type=int, default=None, metavar='TICKS',
+                        help="time binary state snapshots and deltas over TICKS headless ticks")
+    parser.add_argument('--level-bench', type=int, default=None, metavar='CHUNKS',
+                        help="compare generating CHUNKS level chunks with streaming them from a baked file")
+    parser.add_argument('--bake-level', default=None, metavar='PATH',
+                        help="generate a level from --seed and write it to PATH (see --level-chunks)")
+    parser.add_argument('--level-chunks', type=int, default=64, help="chunks in a level written by --bake-level")
+    parser.add_argument('--render-bench', action='store_true',
+                        help="compare per-sprite Group.draw with the batched renderer at 10, 1000 and 10000 sprites")
+    parser.add_argument('--particle-bench', type=int, default=None, metavar='N',
+                        help="time updating and drawing about N live particles")
+    parser.add_argument('--render-scale', type=int, choices=(1, 2, 4), default=1,
+                        help="draw at 1/N resolution and let SDL scale the window up")
+    parser.add_argument('--render-scale-bench', type=int, default=None, metavar='FRAMES',
+                        help="time drawing FRAMES frames at 1/1, 1/2 and 1/4 resolution")
+    parser.add_argument('--governor', action='store_true',
+                        help="adapt effects, bullet and pickup limits and block waves to hold the frame budget")
+    parser.add_argument('--frame-budget', type=float, default=1000.0 / FPS, metavar='MS',
+                        help="frame time the --governor aims for (default: one frame at %d FPS)" % FPS)
+    parser.add_argument('--batch', type=int, default=None, metavar='GAMES', help="play GAMES headless bot games in parallel")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes for --batch (default: one per core)")
+    parser.add_argument('--batch-scaling', action='store_true', help="repeat --batch with 1, 2, 4... workers up to --workers")
+    parser.add_argument('--log', action='append', default=[], metavar='CATEGORY=LEVEL',
+                        help="log level per category (%s or all), e.g. --log bullet=DEBUG" % ', '.join(LOG_CATEGORIES))
+    parser.add_argument('--log-file', default=None, help="write log records here from a background thread (default stderr)")
+    args = parser.parse_args()
+    asset_manager.use_atlas = args.atlas
+    levels = {}
+    for item in args.log:
+        category, _, level = item.partition('=')
+        if category not in LOG_CATEGORIES + ['all'] or not isinstance(logging.getLevelName(level.upper()), int):
+            parser.error("--log expects CATEGORY=LEVEL with CATEGORY one of %s or all and LEVEL a logging level, "
+                         "not %r" % (', '.join(LOG_CATEGORIES), item))
+        levels[category] = level
+    if (args.governor and 'governor' not in levels
+            and logging.getLevelName(levels.get('all', 'WARNING').upper()) > logging.INFO):
+        # the governor's quality changes are logged at INFO; record them unless told otherwise
+        levels['governor'] = 'INFO'
+    log_stream = open(args.log_file, 'a') if args.log_file else sys.stderr
+    setup_logging(levels, log_stream)
+    try:
+        profiler = None
+        if args.profile or args.profile_trace:
+            profiler = FrameProfiler(trace=args.profile_trace is not None)
+        if args.batch:
+            workers = args.workers or os.cpu_count() or 1
+            counts = [workers]
+            if args.batch_scaling:
+                counts = sorted(set([2 ** i for i in range(workers.bit_length()) if 2 ** i < workers] + [workers]))
+            baseline = None
+            for count in counts:
+                results, wall = run_batch(args.batch, count, args.seed or 0, swarm_size=args.swarm)
+                baseline = baseline or wall
+                for line in batch_report(results, wall, count):
+                    print(line)
+                print("speedup over %d worker(s): %.2fx" % (counts[0], baseline / wall))
+        elif args.bake_level:
+            if args.level_chunks < 1:
+                parser.error("--level-chunks must be at least 1")
+            bake_level(args.bake_level, args.seed or 0, args.level_chunks)
+            print("level: wrote %d chunks to %s" % (args.level_chunks, args.bake_level))
+        elif args.level_bench:
+            results = run_level_bench(args.level_bench, args.seed)
+            print("level: baked %d chunks in %.1f ms, %.1f KiB on disk" %
+                  (args.level_bench, results['baked']['bake_ms'], results['baked']['file_kb']))
+            for name in ('generated', 'baked'):
+                memory = results[name]['resident_kb']
+                print("level %-9s load %.3f ms, %.1f us per chunk streamed, resident %s" %
+                      (name, results[name]['load_ms'], results[name]['chunk_us'],
+                       'n/a' if memory is None else '%d KiB private + %d KiB file-backed' % memory))
+        elif args.render_bench:
+            for count, (group_ms, blits_ms, batched_ms) in sorted(run_render_bench(seed=args.seed).items()):
+                print("render %5d sprites: Group.draw %.3f ms, blits %.3f ms, batched %.3f ms" %
+                      (count, group_ms, blits_ms, batched_ms))
+        elif args.render_scale_bench:
+            for scale, (static_ms, frame_ms, upscale_ms) in sorted(run_render_scale_bench(args.render_scale_bench, args.seed,
+                                                                                           args.swarm).items()):
+                print("render 1/%d (%dx%d): level fill+tiles %.3f ms, frame %.3f ms, software upscale %.3f ms" %
+                      (scale, SCREEN_WIDTH // scale, SCREEN_HEIGHT // scale, static_ms, frame_ms, upscale_ms))
+        elif args.particle_bench:
+            live, update_ms, draw_ms = run_particle_bench(args.particle_bench, seed=args.seed)
+            print("particles: %.0f live, update %.3f ms, draw %.3f ms per frame (budget %.1f ms)" %
+                  (live, update_ms, draw_ms, 1000.0 / FPS))
+        elif args.snapshot_bench:
+            results = run_snapshot_bench(args.snapshot_bench, args.seed, args.swarm)
+            print("snapshot: save %.1f us, decode %.1f us, load %.1f us, delta %.1f us" %
+                  (results['save_us'], results['unpack_us'], results['load_us'], results['delta_us']))
+            print("snapshot: %.0f bytes, %.0f compressed, %.0f per delta" %
+                  (results['full_bytes'], results['compressed_bytes'], results['delta_bytes']))
+        elif args.net_test:
+            stats, mismatches = run_net_test(args.net_test, args.seed, args.net_latency, args.net_jitter, args.net_loss,
+                                             args.swarm)
+            for role, role_stats in sorted(stats.items()):
+                print("net %s: %s" % (role, role_stats))
+            print("net test: %s" % ("in sync" if mismatches == 0 else "%d mismatched ticks" % mismatches))
+        elif args.host is not None or args.join:
+            if args.join:
+                address, _, port = args.join.partition(':')
+                transport = UdpTransport(0, (address, int(port or NET_PORT)), args.net_latency, args.net_jitter, args.net_loss)
+                run_netplay('ground', transport, dirty_rects=args.dirty_rects)
+            else:
+                transport = UdpTransport(args.host, None, args.net_latency, args.net_jitter, args.net_loss)
+                run_netplay('plane', transport, args.seed, args.swarm, args.dirty_rects)
+        elif args.replay:
+            ticks, tps, mismatch = run_replay(args.replay)
+            if mismatch is None:
+                print("replay: %d ticks verified, %.0f ticks/sec" % (ticks, tps))
+            else:
+                print("replay: state diverged at tick %d" % mismatch)
+        elif args.headless:
+            game, ticks, tps = run_headless(args.ticks, args.seed, swarm_size=args.swarm, profiler=profiler)
+            print("headless: %d ticks, score %d, %.0f ticks/sec" % (ticks, game.score, tps))
+            if profiler is not None:
+                for phase in FrameProfiler.PHASES:
+                    figures = profiler.percentiles(phase)
+                    if figures is not None:
+                        print("%-16s p50 %.4f  p95 %.4f  p99 %.4f ms" % ((phase,) + figures))
+            for name, pool in (('bullets', bullet_pool), ('ammoboxes', ammobox_pool), ('blocks', block_pool)):
+                print("pool %s: %s" % (name, pool.stats()))
+        else:
+            governor = FrameGovernor(args.frame_budget) if args.governor else None
+            if args.dirty_rects and args.render_scale != 1:
+                parser.error("--dirty-rects only draws at full resolution")
+            main(args.dirty_rects, args.swarm, args.fixed_step, args.display_fps, args.seed, args.record, profiler, governor,
+                 args.render_scale)
+        if profiler is not None and args.profile_trace:
+            profiler.export(args.profile_trace)
+    finally:
+        shutdown_logging()
+        if log_stream is not sys.stderr:
+            log_stream.close()